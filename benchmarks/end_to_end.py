@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# end to end benchmark of teraflops commands against stand-ins for terraform, tofu, nix, nix-build, nix-instantiate,
+# colmena and ssh, runs offline on a single machine
+#
+# every node of the synthetic deployment points at a local tcp listener so waiting for nodes works without a network,
+# the stand-ins sleep for --latency seconds per invocation and ssh prints --output-size bytes per command
+#
+# usage: python benchmarks/end_to_end.py [--sizes 10,100,1000,10000] [--commands deploy,check] [--save FILE] [--baseline FILE]
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# every stand-in logs nothing and only does what teraflops needs from it
+prologue = '''#!/bin/sh
+[ "$BENCH_LATENCY" = 0 ] || sleep "$BENCH_LATENCY"
+'''
+
+terraform = prologue + '''case "$1" in
+  show) cat "$BENCH_STATE";;
+esac
+'''
+
+stubs = {
+  'terraform': terraform,
+  'tofu': terraform,
+  'nix': prologue + '''case "$*" in
+  *"flake metadata"*) echo '{"resolvedUrl":"path:/bench","locked":{"narHash":"sha256-bench"},"path":"/bench"}';;
+  *" eval "*) for last; do :; done; printf '%s\\n' "$last" | grep -v '^($' | sed 's/^)$/,/' | tr -d '\\n' | sed 's/,]$/]/';;
+esac
+''',
+  'nix-build': prologue + '''while [ $# -gt 0 ]; do case "$1" in --out-link) shift; out="$1";; esac; shift; done
+echo '{"resource":{"terraform_data":{"bench":{}}},"terraform":{"required_providers":{}}}' > "$out"
+''',
+  'nix-instantiate': prologue + '''echo '{}'
+''',
+  'colmena': prologue + '''case "$*" in
+  *" eval "*) for last; do :; done; n=$(echo "$last" | grep -o ') args)' | wc -l); seq 0 $((n - 1)) | paste -sd, | sed 's/.*/[&]/';;
+esac
+''',
+  'ssh': prologue + '''case "$*" in
+  *" -O exit"*|*" reboot") ;;
+  *boot_id*) echo $$;;
+  *) head -c "$BENCH_OUTPUT_SIZE" /dev/zero | tr '\\0' x; echo;;
+esac
+''',
+}
+
+commands = {
+  'deploy': ['deploy', '--confirm'],
+  'check': ['check'],
+  'ssh-for-each': ['ssh-for-each', 'true'],
+  'reboot': ['reboot'],
+  'info': ['info'],
+  'set-args': ['set-args', '--arg', 'replicas', '3', '--argstr', 'domain', 'example.com'],
+}
+
+# accepts and immediately closes connections, stands in for the ssh port of every node
+def listener():
+  server = socket.socket()
+  server.bind(('127.0.0.1', 0))
+  server.listen(1024)
+
+  def serve():
+    while True:
+      connection, _ = server.accept()
+      connection.close()
+
+  threading.Thread(target=serve, daemon=True).start()
+
+  return server.getsockname()[1]
+
+def synthetic_state(size, port):
+  nodes = dict()
+  resources = [dict(address='terraform_data.teraflops-arguments', type='terraform_data', name='teraflops-arguments', values=dict(input=dict()))]
+
+  for i in range(size):
+    name = f'node-{i}'
+    nodes[name] = dict(targetHost='127.0.0.1', targetPort=port, targetUser='root', tags=[f'group-{i % 10}'], targetEnv='hcloud', provisionSSHKey=True)
+    resources.append(dict(address=f'hcloud_server.{name}', type='hcloud_server', name=name, values=dict(id=str(i), ipv4_address='127.0.0.1')))
+    resources.append(dict(address=f'ssh_resource.{name}', type='ssh_resource', name=name, values=dict(id=str(i), result='{}')))
+
+  teraflops = dict(version=1, privateKey='KEY', nodes=nodes)
+
+  return dict(format_version='1.0', values=dict(outputs=dict(teraflops=dict(sensitive=True, value=teraflops)), root_module=dict(resources=resources)))
+
+def setup(workdir, size, port):
+  bindir = os.path.join(workdir, 'bin')
+  os.makedirs(bindir)
+
+  for name, script in stubs.items():
+    path = os.path.join(bindir, name)
+    with open(path, 'w') as fp:
+      fp.write(script)
+    os.chmod(path, 0o755)
+
+  deployment = os.path.join(workdir, 'deployment')
+  os.makedirs(deployment)
+
+  with open(os.path.join(deployment, 'flake.lock'), 'w') as fp:
+    fp.write('{}')
+
+  # a local state file lets the node inventory be reused between commands just like in a real deployment
+  with open(os.path.join(deployment, 'terraform.tfstate'), 'w') as fp:
+    json.dump(dict(lineage='bench', serial=size), fp)
+
+  with open(os.path.join(workdir, 'state.json'), 'w') as fp:
+    json.dump(synthetic_state(size, port), fp)
+
+  return bindir, deployment
+
+def run(command, bindir, deployment, args):
+  env = dict(os.environ)
+  env['PATH'] = bindir + os.pathsep + env['PATH']
+  env['PYTHONPATH'] = os.pathsep.join([root] + [env['PYTHONPATH']] if env.get('PYTHONPATH') else [root])
+  env['BENCH_STATE'] = os.path.join(os.path.dirname(bindir), 'state.json')
+  env['BENCH_LATENCY'] = str(args.latency)
+  env['BENCH_OUTPUT_SIZE'] = str(args.output_size)
+
+  cmd = [sys.executable, '-m', 'teraflops.main', '--no-daemon'] + commands[command]
+
+  start = time.perf_counter()
+  process = subprocess.run(cmd, cwd=deployment, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  elapsed = time.perf_counter() - start
+
+  if process.returncode != 0:
+    raise SystemExit(f'{command} failed with exit code {process.returncode}:\n{process.stderr.decode()}')
+
+  return elapsed
+
+def bench(args):
+  port = listener()
+  results = dict()
+
+  for size in args.sizes:
+    with tempfile.TemporaryDirectory(prefix='teraflops-bench.') as workdir:
+      bindir, deployment = setup(workdir, size, port)
+
+      for command in args.commands:
+        timings = [run(command, bindir, deployment, args) for _ in range(args.repeat)]
+        results[f'{command}/{size}'] = statistics.median(timings)
+
+        print(f'{command:>12} | {size:>6} nodes | median {statistics.median(timings):8.3f} s | min {min(timings):8.3f} s | max {max(timings):8.3f} s', flush=True)
+
+  return results
+
+# a regression is slower than the baseline by more than the relative threshold and the absolute noise floor
+def regressions(results, baseline, threshold, noise):
+  for key, elapsed in sorted(results.items()):
+    if key in baseline and elapsed > baseline[key] * (1 + threshold) and elapsed - baseline[key] > noise:
+      yield key, baseline[key], elapsed
+
+def main():
+  parser = argparse.ArgumentParser(description='time teraflops commands end to end against stand-ins for its external tools')
+  parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')], default=[10, 100, 1000], help='comma separated deployment sizes, in nodes (default: 10,100,1000)')
+  parser.add_argument('--commands', type=lambda value: value.split(','), default=list(commands), help='comma separated commands to time (default: %s)' % ','.join(commands))
+  parser.add_argument('--repeat', type=int, default=3, help='runs per command and size, the median is reported (default: 3)')
+  parser.add_argument('--latency', type=float, default=0, help='seconds every stand-in sleeps before doing anything (default: 0)')
+  parser.add_argument('--output-size', type=int, default=64, help='bytes of output per ssh command (default: 64)')
+  parser.add_argument('--save', metavar='FILE', help='write the results to FILE for use as a later --baseline')
+  parser.add_argument('--baseline', metavar='FILE', help='fail when a result is slower than the one in FILE beyond the threshold')
+  parser.add_argument('--threshold', type=float, default=0.2, help='tolerated relative slowdown compared to the baseline (default: 0.2)')
+  parser.add_argument('--noise', type=float, default=0.05, help='slowdowns of fewer seconds than this are never a regression (default: 0.05)')
+  args = parser.parse_args()
+
+  unknown = set(args.commands) - set(commands)
+  if unknown:
+    parser.error('unknown command(s): %s' % ', '.join(sorted(unknown)))
+
+  results = bench(args)
+
+  if args.save:
+    with open(args.save, 'w') as fp:
+      json.dump(results, fp, indent=2, sort_keys=True)
+
+  if args.baseline:
+    with open(args.baseline, 'r') as fp:
+      baseline = json.load(fp)
+
+    failed = list(regressions(results, baseline, args.threshold, args.noise))
+    for key, before, after in failed:
+      print(f'REGRESSION {key}: {before:.3f} s -> {after:.3f} s (+{(after / before - 1) * 100:.0f}%)')
+
+    if failed:
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+# benchmark for selecting nodes with --on on large inventories
+#
+# usage: python benchmarks/node_filter.py [SIZE...]
+
+import os
+import random
+import sys
+import time
+
+# run from anywhere without installing teraflops first
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from teraflops.main import NodeFilter
+
+FILTERS = [
+  'web-42',
+  'web-*',
+  '@role-3',
+  '@region-*&@role-1',
+  '@role-1,@role-2,!web-1*',
+  '!@region-eu',
+]
+
+def synthetic_nodes(size):
+  random.seed(size)
+
+  return {
+    f'web-{i}': dict(tags=[f'role-{random.randrange(50)}', f'region-{random.choice(["eu", "us", "ap"])}', f'rack-{i // 40}'] + [f'label-{random.randrange(1000)}' for _ in range(5)])
+    for i in range(size)
+  }
+
+def bench(size):
+  nodes = synthetic_nodes(size)
+
+  for filter_str in FILTERS:
+    start = time.perf_counter()
+    selected = NodeFilter(filter_str).filter(nodes)
+    elapsed = time.perf_counter() - start
+
+    print(f'{size:>8} nodes | {filter_str:<28} | {len(selected):>8} selected | {elapsed * 1000:8.1f} ms')
+
+if __name__ == '__main__':
+  for size in [int(arg) for arg in sys.argv[1:]] or [10_000]:
+    bench(size)
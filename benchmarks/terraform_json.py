@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+# benchmark for converting `terraform show -json` into the terraform.json file consumed by eval.nix
+#
+# usage: python benchmarks/terraform_json.py [SIZE...]
+
+import json
+import os
+import random
+import sys
+import time
+
+# run from anywhere without installing teraflops first
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from teraflops.main import TerraformState
+
+def synthetic_state(size):
+  resources = []
+
+  # a third of each: plain resources, resources created with `count` and resources created with `for_each`
+  for i in range(size // 3):
+    resources.append(dict(address=f'hcloud_server.node-{i}', type='hcloud_server', name=f'node-{i}', values=dict(id=str(i), ipv4_address=f'10.0.{i // 256 % 256}.{i % 256}')))
+
+  counted = [
+    dict(address=f'hcloud_volume.data[{i}]', type='hcloud_volume', name='data', index=i, values=dict(id=str(i), size=10))
+    for i in range(size // 3)
+  ]
+  random.shuffle(counted)
+  resources += counted
+
+  for i in range(size - len(resources)):
+    resources.append(dict(address=f'ssh_resource.infect["node-{i}"]', type='ssh_resource', name='infect', index=f'node-{i}', values=dict(id=str(i), result='{}')))
+
+  return dict(format_version='1.0', values=dict(outputs=dict(), root_module=dict(resources=resources)))
+
+def bench(size):
+  state = TerraformState('terraform')
+  state.data = synthetic_state(size)
+
+  start = time.perf_counter()
+  resources = state.resources()
+  built = time.perf_counter()
+  output = json.dumps(dict(outputs=state.outputs(), resources=resources), separators=(',', ':'))
+  written = time.perf_counter()
+
+  assert all(volume['id'] == str(i) for i, volume in enumerate(resources['hcloud_volume']['data']))
+
+  print(f'{size:>8} resources | build {(built - start) * 1000:8.1f} ms | serialize {(written - built) * 1000:8.1f} ms | {len(output) / 1024 / 1024:6.1f} MiB')
+
+if __name__ == '__main__':
+  for size in [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]:
+    bench(size)
@@ -119,7 +119,7 @@ in
         # sourced from https://github.com/NixOS/nixpkgs/pull/258250
         net = (import ./net.nix { inherit lib; });
 
-        metadata = builtins.fromJSON resources.ssh_resource.${name}.result;
+        metadata = resources.ssh_resource.${name}.result_json or (builtins.fromJSON resources.ssh_resource.${name}.result);
         public = head metadata.interfaces.public;
         private = head metadata.interfaces.private;
       in
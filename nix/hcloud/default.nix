@@ -5,7 +5,7 @@ in
 {
   defaults = { name, config, pkgs, lib, ... }: with lib;
   let
-    remoteCfg = builtins.fromJSON resources.ssh_resource.${name}.result;
+    remoteCfg = resources.ssh_resource.${name}.result_json or (builtins.fromJSON resources.ssh_resource.${name}.result);
   in
   {
     options.deployment.hcloud = mkOption {
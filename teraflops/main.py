@@ -3,14 +3,24 @@
 import argparse
 import asyncio
 import contextlib
+import contextvars
+import fnmatch
+import hashlib
 import json
 import logging
 import os
+import random
 import re
 import shutil
+import socket
+import socketserver
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import tomllib
 
 from importlib.resources import files
 from termcolor import colored
@@ -28,43 +38,606 @@ class ColmenaFormatter(logging.Formatter):
   def format(self, record):
     return '[' + self._prefix[record.levelno] + '] ' + super().format(record)
 
+# records a span for every external command and node task so we can tell where the time of an invocation went, see
+# --verbose for a summary and --trace-file for the chrome trace event format (chrome://tracing, perfetto, speedscope)
+class Tracer:
+  # tools whose first positional argument says what they're doing, ie. `terraform show` vs `terraform apply`
+  subcommands = ['colmena', 'nix', 'terraform', 'tofu']
+
+  def __init__(self):
+    self.enabled = False
+    self.origin = time.monotonic()
+    self.spans = list()
+    self.node = contextvars.ContextVar('node', default=None)
+
+  @classmethod
+  def stage(cls, cmd):
+    name = os.path.basename(cmd[0])
+    if name not in cls.subcommands:
+      return name
+
+    args = iter(cmd[1:])
+    for arg in args:
+      if arg.startswith('--') and '=' not in arg:
+        next(args, None)
+      elif not arg.startswith('-'):
+        return f'{name} {arg}'
+
+    return name
+
+  def start(self, name, category, node=None, **args):
+    if not self.enabled:
+      return None
+
+    span = dict(name=name, category=category, node=node or self.node.get(), start=time.monotonic(), end=None, returncode=None, bytes=None, args=args)
+    self.spans.append(span)
+
+    return span
+
+  def end(self, span, returncode=None, output=None):
+    if span is None:
+      return
+
+    span['end'] = time.monotonic()
+    if returncode is not None:
+      span['returncode'] = returncode
+    if output is not None:
+      span['bytes'] = output
+
+  # spans started within, including those of processes, are attributed to `node`
+  @contextlib.contextmanager
+  def span(self, name, category, node=None):
+    token = self.node.set(node) if node else None
+    span = self.start(name, category, node)
+    try:
+      yield span
+    finally:
+      self.end(span)
+      if token:
+        self.node.reset(token)
+
+  @staticmethod
+  def output_size(*outputs):
+    sizes = [len(output) for output in outputs if isinstance(output, (bytes, str))]
+    return sum(sizes) if sizes else None
+
+  # a drop in replacement for subprocess.run
+  def run(self, cmd, node=None, **kwargs):
+    span = self.start(self.stage(cmd), 'process', node, cmd=' '.join(cmd))
+    try:
+      process = subprocess.run(cmd, **kwargs)
+    except subprocess.CalledProcessError as e:
+      self.end(span, e.returncode, self.output_size(e.stdout, e.stderr))
+      raise
+    except BaseException:
+      self.end(span)
+      raise
+
+    self.end(span, process.returncode, self.output_size(process.stdout, process.stderr))
+    return process
+
+  # a drop in replacement for asyncio.create_subprocess_exec, the span ends once the process has been waited for
+  async def create_subprocess_exec(self, *cmd, node=None, **kwargs):
+    span = self.start(self.stage(cmd), 'process', node, cmd=' '.join(cmd))
+    try:
+      proc = await asyncio.create_subprocess_exec(*cmd, **kwargs)
+    except BaseException:
+      self.end(span)
+      raise
+
+    if span is None:
+      return proc
+
+    wait, communicate = proc.wait, proc.communicate
+
+    async def traced_wait():
+      returncode = await wait()
+      self.end(span, returncode)
+      return returncode
+
+    async def traced_communicate(input=None):
+      stdout, stderr = await communicate(input)
+      self.end(span, proc.returncode, self.output_size(stdout, stderr))
+      return stdout, stderr
+
+    proc.wait, proc.communicate = traced_wait, traced_communicate
+    return proc
+
+  def summary(self):
+    stages = dict()
+    for span in self.spans:
+      stage = stages.setdefault((span['category'], span['name']), dict(count=0, failed=0, total=0.0, max=0.0, bytes=0))
+      duration = (span['end'] or time.monotonic()) - span['start']
+
+      stage['count'] += 1
+      stage['failed'] += 1 if span['returncode'] else 0
+      stage['total'] += duration
+      stage['max'] = max(stage['max'], duration)
+      stage['bytes'] += span['bytes'] or 0
+
+    if not stages:
+      return
+
+    width = max(len(name) for _, name in stages)
+    logging.debug(f'{"STAGE".ljust(width)}  {"COUNT":>6}  {"FAILED":>6}  {"TOTAL":>9}  {"MAX":>9}  {"OUTPUT":>10}')
+    for (category, name), stage in sorted(stages.items(), key=lambda item: item[1]['total'], reverse=True):
+      logging.debug(f'{name.ljust(width)}  {stage["count"]:>6}  {stage["failed"]:>6}  {stage["total"]:>8.2f}s  {stage["max"]:>8.2f}s  {stage["bytes"]:>9}B')
+
+  # chrome trace event format, each node gets a lane of its own
+  def export(self, path):
+    pid = os.getpid()
+    lanes = {None: 0}
+    events = list()
+
+    for span in self.spans:
+      lane = lanes.setdefault(span['node'], len(lanes))
+      args = dict(span['args'], node=span['node'], returncode=span['returncode'], bytes=span['bytes'])
+      events.append({
+        'name': span['name'],
+        'cat': span['category'],
+        'ph': 'X',
+        'ts': round((span['start'] - self.origin) * 1e6),
+        'dur': round(((span['end'] or time.monotonic()) - span['start']) * 1e6),
+        'pid': pid,
+        'tid': lane,
+        'args': {key: value for key, value in args.items() if value is not None},
+      })
+
+    for node, lane in lanes.items():
+      events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': lane, 'args': {'name': node or 'teraflops'}})
+
+    with open(path, 'w') as fp:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+
+tracer = Tracer()
+
 # adapted from https://github.com/zhaofengli/colmena/blob/main/src/nix/node_filter.rs
+#
+# in addition to colmena's syntax `&` selects the intersection of rules (ie. `@web&@eu`) and a leading `!` excludes
+# the nodes a term selects from the result (ie. `@web,!web-3`)
 class NodeFilter:
   def __init__(self, filter_str):
+    self.include = []
+    self.exclude = []
+
     trimmed = filter_str.strip()
     if not trimmed:
       logging.warning(f'Filter "{filter_str}" is blank and will match nothing')
-      self.rules = []
       return
 
-    self.rules = [
-      Rule(pattern.strip('@') if pattern.startswith('@') else pattern)
-      for pattern in trimmed.split(',')
-    ]
+    for term in trimmed.split(','):
+      term = term.strip()
+      if not term:
+        continue
+
+      if term.startswith('!'):
+        self.exclude.append(Term(term[1:]))
+      else:
+        self.include.append(Term(term))
 
   def filter(self, nodes):
-    if not self.rules:
+    if not self.include and not self.exclude:
       return dict()
 
-    result = dict()
-    for name, node in nodes.items():
-      for rule in self.rules:
-        if rule.matches_name(name):
-          result[name] = node
-        elif rule.matches_tag(node['tags']):
-          result[name] = node
+    # inverted index of tags, so tag rules don't need to look at every node
+    tags = dict()
+    if any(rule.tag for term in self.include + self.exclude for rule in term.rules):
+      for name, node in nodes.items():
+        for tag in node['tags']:
+          tags.setdefault(tag, set()).add(name)
+
+    if self.include:
+      selected = set().union(*[term.select(nodes, tags) for term in self.include])
+    else:
+      selected = set(nodes)
+
+    for term in self.exclude:
+      selected -= term.select(nodes, tags)
 
-    return result
+    return {name: node for name, node in nodes.items() if name in selected}
+
+# the intersection of one or more rules
+class Term:
+  def __init__(self, term):
+    self.rules = [Rule(pattern.strip()) for pattern in term.split('&')]
+
+  def select(self, nodes, tags):
+    selected = None
+    for rule in self.rules:
+      selected = rule.select(nodes, tags) if selected is None else selected & rule.select(nodes, tags)
+      if not selected:
+        break
+
+    return selected
 
 class Rule:
   def __init__(self, pattern):
-    self.pattern = pattern
+    self.tag = pattern.startswith('@')
+    self.pattern = pattern[1:] if self.tag else pattern
+
+    # like colmena patterns are globs which match the whole name or tag, literals are simply looked up
+    self.literal = not any(c in self.pattern for c in '*?[')
+    self.regex = None if self.literal else re.compile(fnmatch.translate(self.pattern))
+
+  def matches(self, value):
+    return value == self.pattern if self.literal else self.regex.match(value) is not None
+
+  def select(self, nodes, tags):
+    if self.tag:
+      if self.literal:
+        return tags.get(self.pattern, set())
+
+      return set().union(*[names for tag, names in tags.items() if self.matches(tag)])
+
+    if self.literal:
+      return {self.pattern} if self.pattern in nodes else set()
+
+    return {name for name in nodes if self.matches(name)}
+
+# share one master connection per host between every ssh, scp and colmena process
+def ssh_control(tempdir, persist=None):
+  if persist:
+    # masters outlive this invocation so they need a stable, and short, location (see unix(7) regarding sun_path)
+    control_dir = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), 'teraflops-%d' % os.getuid())
+  else:
+    control_dir = os.path.join(tempdir, 'ssh')
+
+  os.makedirs(control_dir, mode=0o700, exist_ok=True)
+
+  # anyone who can create a socket in there could pose as a master and be handed our sessions
+  st = os.lstat(control_dir)
+  if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+    logging.error(f'{control_dir} must be a directory owned by the current user with mode 0700')
+    sys.exit(1)
+
+  os.environ['TERAFLOPS_SSH_CONTROL_DIR'] = control_dir
+  os.environ['TERAFLOPS_SSH_CONTROL_PERSIST'] = persist or '60'
+
+def ssh_control_options():
+  if not os.environ.get('TERAFLOPS_SSH_CONTROL_DIR'):
+    return dict()
+
+  return {
+    'ControlMaster': 'auto',
+    'ControlPath': os.path.join(os.environ['TERAFLOPS_SSH_CONTROL_DIR'], '%C'),
+    'ControlPersist': os.environ['TERAFLOPS_SSH_CONTROL_PERSIST'],
+    # notice a master whose host went away (ie. a reboot) instead of hanging every multiplexed session on it
+    'ServerAliveInterval': '5',
+    'ServerAliveCountMax': '3',
+  }
+
+def ssh_control_args():
+  return [arg for key, value in ssh_control_options().items() for arg in ['-o', f'{key}={value}']]
+
+# close the master connections of this invocation unless they were asked to persist
+def ssh_control_exit(tempdir):
+  control_dir = os.environ.get('TERAFLOPS_SSH_CONTROL_DIR')
+  if not control_dir or os.path.dirname(control_dir) != tempdir:
+    return
+
+  try:
+    paths = os.listdir(control_dir)
+  except FileNotFoundError:
+    return
+
+  if not paths:
+    return
+
+  # there is a master per node so close them concurrently, as many at a time as nodes are handled by default
+  async def close(path, limit):
+    async with limit:
+      proc = await tracer.create_subprocess_exec('ssh', '-o', 'ControlPath=%s' % os.path.join(control_dir, path), '-O', 'exit', 'teraflops', stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+      await proc.wait()
+
+  async def run():
+    limit = asyncio.Semaphore(Scheduler.default_parallel)
+    await asyncio.gather(*[close(path, limit) for path in paths])
+
+  asyncio.run(run())
+
+# runs an async task per node with bounded concurrency, optionally capped per tag as well
+class Scheduler:
+  # like colmena, 0 disables the limit
+  default_parallel = 32
+
+  def __init__(self, parallel=None, tag_limits=None, fail_fast=False):
+    self.parallel = self.default_parallel if parallel is None else parallel
+    self.tag_limits = dict(tag_limits or [])
+    self.fail_fast = fail_fast
+
+    self.failed = list()
+    self.skipped = list()
+    self.timings = dict()
+
+  # `task` returns False to signal failure, anything else is considered a success
+  async def run(self, nodes, task):
+    limit = asyncio.Semaphore(self.parallel) if self.parallel > 0 else contextlib.nullcontext()
+    tag_limits = {tag: asyncio.Semaphore(value) for tag, value in self.tag_limits.items()}
+    aborted = asyncio.Event()
+
+    async def worker(name, node):
+      queued = time.monotonic()
+
+      async with contextlib.AsyncExitStack() as stack:
+        # always acquire in the same order so nodes sharing multiple capped tags can't deadlock
+        for tag in sorted(tag_limits.keys() & set(node.get('tags') or [])):
+          await stack.enter_async_context(tag_limits[tag])
+        await stack.enter_async_context(limit)
+
+        if aborted.is_set():
+          self.skipped.append(name)
+          return None
+
+        started = time.monotonic()
+        with tracer.span(task.__name__, 'node', name):
+          result = await task(name, node)
+        self.timings[name] = (started - queued, time.monotonic() - started)
+
+      if result is False:
+        self.failed.append(name)
+        if self.fail_fast:
+          aborted.set()
+
+      return result
+
+    results = await asyncio.gather(*[worker(name, node) for name, node in nodes.items()])
+
+    for name, (wait, wall) in sorted(self.timings.items()):
+      logging.debug(f'{name}: queued for {wait:.2f}s, ran for {wall:.2f}s')
+
+    if self.skipped:
+      logging.error(f'Aborted after {len(self.failed)} failure(s), {len(self.skipped)} node(s) skipped.')
+
+    return dict(zip(nodes.keys(), results))
+
+# runs blocking stages (ie. ones starting a subprocess) concurrently on threads, each stage starts as soon as every
+# stage it depends on has finished - which have to be added first, so there can't be any cycles
+class TaskGraph:
+  def __init__(self):
+    self.stages = dict()
+
+  def add(self, name, func, after=()):
+    unknown = [dependency for dependency in after if dependency not in self.stages]
+    if unknown:
+      raise ValueError(f'stage "{name}" depends on unknown stage(s): {", ".join(unknown)}')
+
+    self.stages[name] = (func, list(after))
+
+  def run(self):
+    async def run():
+      tasks = dict()
+
+      async def stage(name, func, after):
+        await asyncio.gather(*[tasks[dependency] for dependency in after])
+
+        with tracer.span(name, 'stage'):
+          return await asyncio.to_thread(func)
+
+      for name, (func, after) in self.stages.items():
+        tasks[name] = asyncio.create_task(stage(name, func, after))
+
+      return dict(zip(tasks, await asyncio.gather(*tasks.values())))
 
-  def matches_name(self, name):
-    return re.match(self.pattern, name) is not None
+    return asyncio.run(run())
 
-  def matches_tag(self, tags):
-    return any(re.match(self.pattern, tag) for tag in tags)
+# prints whole lines prefixed by the name of the node they came from, optionally copying them to a log file per node
+class NodeOutput:
+  def __init__(self, names, log_dir=None):
+    self.length = len(max(names, key = len)) if names else len('ERROR')
+    self.log_dir = log_dir
+    self.logs = dict()
+
+    if log_dir:
+      os.makedirs(log_dir, exist_ok=True)
+
+  def print(self, name, line, color=None):
+    # a single write per line so output of concurrent nodes never interleaves, flushed right away as stdout is block
+    # buffered when it is a pipe (ie. `ssh-for-each -- journalctl -f | grep ...`)
+    sys.stdout.write(colored(name.ljust(self.length), color=color, attrs=['bold']) + ' | ' + (colored(line, color=color) if color else line) + '\n')
+    sys.stdout.flush()
+
+    if self.log_dir:
+      if name not in self.logs:
+        self.logs[name] = open(os.path.join(self.log_dir, f'{name}.log'), 'w')
+      self.logs[name].write(line + '\n')
+      self.logs[name].flush()
+
+  def close(self):
+    for fp in self.logs.values():
+      fp.close()
+
+# yields lines from an asyncio stream as they arrive without any limit on line length
+async def read_lines(stream):
+  pending = list()
+  while chunk := await stream.read(64 * 1024):
+    # chunks of a line are only joined once it is complete, so a long line costs time linear in its length
+    if b'\n' not in chunk:
+      pending.append(chunk)
+      continue
+
+    *lines, rest = b''.join(pending + [chunk]).split(b'\n')
+    pending = [rest] if rest else []
+
+    for line in lines:
+      yield line.decode(errors='replace').rstrip()
+
+  if pending:
+    yield b''.join(pending).decode(errors='replace').rstrip()
+
+# cheap reachability check before spending an ssh handshake, None when it can't tell (ie. an alias from ~/.ssh/config)
+async def tcp_probe(node, timeout=5):
+  try:
+    _, writer = await asyncio.wait_for(asyncio.open_connection(node['targetHost'], int(node.get('targetPort') or 22)), timeout)
+  except socket.gaierror:
+    return None
+  except (OSError, asyncio.TimeoutError):
+    return False
+
+  writer.close()
+  with contextlib.suppress(OSError):
+    await writer.wait_closed()
+
+  return True
+
+async def boot_id(node):
+  ssh_args = ['-o', 'ConnectTimeout=10'] # see https://github.com/zhaofengli/colmena/issues/166#issuecomment-1892325999
+  proc = await tracer.create_subprocess_exec(*ssh(node, ['cat', '/proc/sys/kernel/random/boot_id'], ssh_args), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+  stdout, _ = await proc.communicate()
+
+  return None if proc.returncode != 0 else stdout.decode().strip()
+
+# the system a node is running right now, None if it can't be told
+async def current_system(node):
+  proc = await tracer.create_subprocess_exec(*ssh(node, ['readlink', '/run/current-system']), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+  stdout, _ = await proc.communicate()
+
+  return None if proc.returncode != 0 else stdout.decode().strip()
+
+# everything `teraflops facts` gathers, in a single ssh round trip per node and without anything beyond coreutils, awk and
+# systemd on the node
+facts_script = '; '.join([
+  'echo "boot_id=$(cat /proc/sys/kernel/random/boot_id)"',
+  'echo "system=$(readlink /run/current-system)"',
+  'echo "kernel=$(uname -r)"',
+  'echo "load=$(cut -d" " -f1-3 /proc/loadavg)"',
+  'echo "memory=$(awk \'/^MemTotal:|^MemAvailable:/ { printf "%s ", $2 }\' /proc/meminfo)"',
+  'echo "disk=$(df -Pk / | awk \'NR == 2 { print $2, $4 }\')"',
+  'echo "failed=$(systemctl list-units --failed --plain --no-legend --no-pager 2>/dev/null | awk \'{ printf "%s ", $1 }\')"',
+])
+
+def parse_facts(output):
+  values = dict(line.partition('=')[::2] for line in output.splitlines() if '=' in line)
+
+  def numbers(key):
+    with contextlib.suppress(ValueError):
+      return [float(value) for value in values.get(key, '').split()]
+    return []
+
+  memory = numbers('memory')
+  disk = numbers('disk')
+
+  return dict(
+    boot_id=values.get('boot_id') or None,
+    system=values.get('system') or None,
+    kernel=values.get('kernel') or None,
+    load=numbers('load') or None,
+    # both are reported in KiB
+    memory=dict(total=int(memory[0]) * 1024, available=int(memory[1]) * 1024) if len(memory) == 2 else None,
+    disk=dict(total=int(disk[0]) * 1024, available=int(disk[1]) * 1024) if len(disk) == 2 else None,
+    failed_units=values.get('failed', '').split(),
+    collected=time.time(),
+  )
+
+async def collect_facts(node):
+  proc = await tracer.create_subprocess_exec(*ssh(node, [facts_script], ['-o', 'ConnectTimeout=10']), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+  stdout, _ = await proc.communicate()
+
+  return None if proc.returncode != 0 else parse_facts(stdout.decode())
+
+def facts_summary(facts):
+  def gib(value):
+    return f'{value / 1024 ** 3:.1f}'
+
+  summary = [facts['kernel'] or 'unknown kernel']
+  if facts['load']:
+    summary.append('load average: ' + ', '.join(f'{value:.2f}' for value in facts['load']))
+  if facts['memory']:
+    summary.append(f'memory: {gib(facts["memory"]["available"])}/{gib(facts["memory"]["total"])} GiB available')
+  if facts['disk']:
+    summary.append(f'disk: {gib(facts["disk"]["available"])}/{gib(facts["disk"]["total"])} GiB available')
+  summary.append(f'{len(facts["failed_units"])} failed unit(s)')
+
+  return ', '.join(summary)
+
+# waits for nodes to become ready with jittered exponential backoff, showing which nodes are still pending
+class NodeWaiter:
+  initial_delay = 1
+  max_delay = 30
+
+  # hosts behind a ProxyJump never answer the tcp probe so ssh is attempted regardless every so often
+  ssh_every = 5
+
+  def __init__(self, timeout=None):
+    self.timeout = timeout
+    self.pending = dict()
+    self.live = sys.stderr.isatty()
+
+  def render(self):
+    if not self.live:
+      return
+
+    status = ''
+    if self.pending:
+      now = time.monotonic()
+      names = ', '.join(f'{name} ({now - started:.0f}s)' for name, started in sorted(self.pending.items(), key=lambda item: item[1]))
+      status = f'Waiting for {len(self.pending)} node(s): {names}'[:shutil.get_terminal_size().columns - 1]
+
+    sys.stderr.write('\r\x1b[K' + status)
+    sys.stderr.flush()
+
+  # print a line without garbling the status line
+  def print(self, *args):
+    if self.live:
+      sys.stderr.write('\r\x1b[K')
+    print(*args, flush=True)
+    self.render()
+
+  # `ready` is called with the node until it returns True, returns False if the node didn't make it in time
+  async def wait(self, name, node, ready):
+    started = time.monotonic()
+    delay = self.initial_delay
+    attempt = 0
+
+    self.pending[name] = started
+    self.render()
+
+    try:
+      with tracer.span('wait', 'node', name):
+        while True:
+          probe = await tcp_probe(node)
+          if probe is not False or attempt % self.ssh_every == self.ssh_every - 1:
+            if await ready(node):
+              return True
+
+          attempt += 1
+          if self.timeout and time.monotonic() - started + delay > self.timeout:
+            return False
+
+          await asyncio.sleep(random.uniform(delay / 2, delay))
+          delay = min(delay * 2, self.max_delay)
+          self.render()
+    finally:
+      del self.pending[name]
+      self.render()
+
+def scp_remote(node, path):
+  remote = ''
+  if node.get('targetUser'):
+    remote += node.get('targetUser')
+    remote += '@'
+  if ':' in node['targetHost']:
+    remote += '['
+    remote += node['targetHost']
+    remote += ']'
+  else:
+    remote += node['targetHost']
+  remote += ':'
+  remote += path
+
+  return remote
+
+# with `since` only files modified since then (ie. written by a copy which started at that time) are counted
+def disk_usage(path, since=None):
+  paths = [path] if not os.path.isdir(path) else [os.path.join(root, filename) for root, _, filenames in os.walk(path) for filename in filenames]
+
+  return sum(st.st_size for st in map(os.stat, paths) if since is None or st.st_mtime >= since)
+
+def tag_limit(value):
+  tag, sep, limit = value.partition('=')
+  if not sep or not tag or not limit.isdigit():
+    raise argparse.ArgumentTypeError(f'"{value}" is not of the form TAG=LIMIT')
+
+  return (tag.strip('@'), int(limit))
 
 def ssh_config(private_key, tempdir):
   ssh_config_file = os.path.join(tempdir, '.ssh', 'config')
@@ -79,6 +652,10 @@ def ssh_config(private_key, tempdir):
     # ConnectTimeout: see https://github.com/zhaofengli/colmena/issues/166#issuecomment-1892325999
     fp.write('Host *\n  ConnectTimeout=10s\n  IdentityFile %s' % private_key_file)
 
+    # colmena only learns about our master connections through this file
+    for key, value in ssh_control_options().items():
+      fp.write('\n  %s=%s' % (key, value))
+
   os.environ['SSH_CONFIG_FILE'] = ssh_config_file
 
 def ssh(node, command, ssh_args=None):
@@ -93,11 +670,13 @@ def ssh(node, command, ssh_args=None):
   if ssh_args:
     cmd += ssh_args
 
+  cmd += ssh_control_args()
+
   if os.environ.get('SSH_CONFIG_FILE'):
     cmd += ['-F', os.environ['SSH_CONFIG_FILE']]
 
   if node.get('targetPort'):
-    cmd += ['-p', node['targetPort']]
+    cmd += ['-p', str(node['targetPort'])]
 
   if node.get('targetUser'):
     cmd += ['-l', node.get('targetUser')]
@@ -107,84 +686,355 @@ def ssh(node, command, ssh_args=None):
 
   return cmd
 
+# a snapshot of `terraform show -json`, read at most once until the state is known to have changed
+class TerraformState:
+  def __init__(self, terraform):
+    self.terraform = terraform
+    self.workdir = None
+    self.invalidate()
+
+  def invalidate(self):
+    self.data = None
+    self.resource_tree = None
+
+  @property
+  def loaded(self):
+    return self.data is not None
+
+  # NOTE: terraform needs a .tf.json file with the backend configuration in the working directory to read the state,
+  # which is `workdir` instead of the project directory if set
+  def load(self):
+    if self.data is None:
+      cmd = [self.terraform]
+      env = None
+
+      if self.workdir:
+        cmd += [f'-chdir={self.workdir}']
+        # TF_DATA_DIR would otherwise be relative to `workdir`
+        env = dict(os.environ, TF_DATA_DIR=os.path.abspath(os.getenv('TF_DATA_DIR', '.terraform')))
+
+      process = tracer.run(cmd + ['show', '-json'], stdout=subprocess.PIPE, env=env, check=True)
+      self.data = json.loads(process.stdout)
+
+    return self.data
+
+  def raw_resources(self):
+    try:
+      return self.load()['values']['root_module']['resources']
+    except KeyError:
+      return list()
+
+  def raw_outputs(self):
+    try:
+      return self.load()['values']['outputs']
+    except KeyError:
+      return dict()
+
+  def arguments(self):
+    for resource in self.raw_resources():
+      if resource['address'] == 'terraform_data.teraflops-arguments':
+        return resource['values']['input']
+
+    return dict()
+
+  def outputs(self):
+    return {key: value['value'] for key, value in self.raw_outputs().items()}
+
+  def resources(self):
+    if self.resource_tree is not None:
+      return self.resource_tree
+
+    resources_data = dict()
+    counted = dict()
+    for resource in self.raw_resources():
+      inner = resources_data.setdefault(resource['type'], dict())
+      index = resource.get('index')
+
+      if index is None:
+        inner[resource['name']] = resource['values']
+      elif type(index) == int:
+        # resources created with `count` are collected first as the state doesn't guarantee any ordering
+        counted.setdefault((resource['type'], resource['name']), dict())[index] = resource['values']
+      else:
+        inner.setdefault(resource['name'], dict())[index] = resource['values']
+
+    for (type_, name), items in counted.items():
+      index = [None] * (max(items) + 1)
+      for offset, values in items.items():
+        index[offset] = values
+
+      resources_data[type_][name] = index
+
+    self.resource_tree = resources_data
+    return resources_data
+
+  # the value of the `teraflops` output injected by eval.nix, if any
+  def teraflops(self):
+    try:
+      return self.raw_outputs()['teraflops']['value']
+    except KeyError:
+      return None
+
+# resolves the flake given by --config at most once per invocation
+class FlakeResolver:
+  def __init__(self, config):
+    self.config = config
+    self._metadata = None
+    self._resolved_url = None
+
+    # startup stages ask for these concurrently, only one of them should run nix
+    self.lock = threading.RLock()
+
+  def metadata(self):
+    with self.lock:
+      if self._metadata is None:
+        process = tracer.run(['nix', '--extra-experimental-features', 'nix-command', 'flake', 'metadata', '--json', self.config], stdout=subprocess.PIPE, check=True)
+        self._metadata = json.loads(process.stdout)
+
+    return self._metadata
+
+  # key for the on-disk cache, only available for local flakes with a lock file
+  def lock_key(self):
+    lock_file = os.path.join(self.config, 'flake.lock')
+
+    try:
+      mtime = os.stat(lock_file).st_mtime_ns
+      with open(lock_file, 'rb') as fp:
+        digest = hashlib.sha256(fp.read()).hexdigest()
+    except OSError:
+      return None
+
+    return '%s:%d:%s' % (os.path.abspath(self.config), mtime, digest)
+
+  # NOTE: only `resolvedUrl` is cached across runs, `narHash` changes with every edit to the flake
+  def resolved_url(self):
+    with self.lock:
+      return self._resolve_url()
+
+  def _resolve_url(self):
+    if self._resolved_url is not None:
+      return self._resolved_url
+
+    tf_data_dir = os.getenv('TF_DATA_DIR', '.terraform')
+    cache_file = os.path.join(tf_data_dir, 'teraflops-flake.json')
+    key = self.lock_key()
+
+    if key is not None:
+      with contextlib.suppress(OSError, ValueError, KeyError):
+        with open(cache_file, 'r') as fp:
+          data = json.load(fp)
+
+        if data['key'] == key:
+          logging.debug(f'flake resolution cache hit ({self.config})')
+          self._resolved_url = data['resolvedUrl']
+          return self._resolved_url
+
+    self._resolved_url = self.metadata()['resolvedUrl']
+
+    if key is not None:
+      with contextlib.suppress(OSError):
+        os.makedirs(tf_data_dir, exist_ok=True)
+        with open(cache_file, 'w') as fp:
+          json.dump(dict(key=key, resolvedUrl=self._resolved_url), fp)
+
+    return self._resolved_url
+
+# path of the state file when the local backend is in use, remote state can't be looked at without terraform
+def local_state_file():
+  tf_data_dir = os.getenv('TF_DATA_DIR', '.terraform')
+
+  try:
+    with open(os.path.join(tf_data_dir, 'terraform.tfstate'), 'r') as fp:
+      backend = json.load(fp).get('backend') or dict()
+  except FileNotFoundError:
+    backend = dict()
+
+  if backend.get('type', 'local') != 'local':
+    return None
+
+  config = backend.get('config') or dict()
+
+  workspace = os.getenv('TF_WORKSPACE')
+  if not workspace:
+    try:
+      with open(os.path.join(tf_data_dir, 'environment'), 'r') as fp:
+        workspace = fp.read().strip()
+    except FileNotFoundError:
+      workspace = 'default'
+
+  if workspace != 'default':
+    return os.path.join(config.get('workspace_dir') or 'terraform.tfstate.d', workspace, 'terraform.tfstate')
+
+  return config.get('path') or 'terraform.tfstate'
+
+def state_serial():
+  path = local_state_file()
+  if path is None:
+    return None
+
+  try:
+    with open(path, 'r') as fp:
+      data = json.load(fp)
+  except FileNotFoundError:
+    return [None, 0]
+
+  return [data.get('lineage'), data.get('serial')]
+
+# terraform addresses which belong to the given nodes: resources named after a node (ie. `hcloud_server.<name>` and
+# `ssh_resource.<name>` as generated by the modules in nix/*) and those which refer to one of them, like a volume
+# attachment - terraform adds whatever these depend on by itself
+def node_targets(main_tf, names):
+  resources = main_tf.get('resource') or dict()
+
+  owned = [f'{type_}.{name}' for type_, blocks in resources.items() for name in blocks if name in names]
+  if not owned:
+    return owned
+
+  refers = re.compile(r'(?<![\w.-])(%s)(?![\w-])' % '|'.join(re.escape(address) for address in owned))
+
+  targets = set(owned)
+  for type_, blocks in resources.items():
+    for name, block in blocks.items():
+      address = f'{type_}.{name}'
+      if address not in targets and refers.search(json.dumps(block)):
+        targets.add(address)
+
+  return sorted(targets)
+
+# adds the decoded `result` of an ssh_resource as `result_json`, when it is JSON at all
+def decode_result(values):
+  if not isinstance(values, dict) or not isinstance(values.get('result'), str):
+    return values
+
+  try:
+    return dict(values, result_json=json.loads(values['result']))
+  except ValueError:
+    return values
+
+def daemon_socket():
+  return os.path.join(os.getenv('TF_DATA_DIR', '.terraform'), 'teraflops.sock')
+
+class DaemonError(Exception):
+  pass
+
+# talks to a `teraflops serve` daemon of the same project, one json request and response per connection
+class DaemonClient:
+  def __init__(self, path):
+    self.path = path
+
+  @classmethod
+  def connect(cls, path, config):
+    if not os.path.exists(path):
+      return None
+
+    client = cls(path)
+    try:
+      response = client.request('hello')
+    except (OSError, ValueError, DaemonError):
+      logging.debug(f'ignoring unresponsive daemon at {path}')
+      return None
+
+    if response['config'] != os.path.abspath(config):
+      logging.debug(f'ignoring daemon at {path} serving {response["config"]}')
+      return None
+
+    return client
+
+  def request(self, command, **kwargs):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      sock.connect(self.path)
+      sock.sendall(json.dumps(dict(kwargs, command=command)).encode() + b'\n')
+
+      with sock.makefile('rb') as fp:
+        line = fp.readline()
+
+    if not line:
+      raise DaemonError('teraflops serve closed the connection without a response')
+
+    response = json.loads(line)
+    if 'error' in response:
+      raise DaemonError(response['error'])
+
+    return response
+
 class App:
+  # number of generated main.tf.json files kept in $TF_DATA_DIR/teraflops
+  main_tf_json_cache_size = 16
+
+  # remote state has no serial we can check cheaply, so the node inventory is only trusted for this many seconds
+  inventory_ttl = 300
+
   def __init__(self, tempdir):
     self.tempdir = tempdir
     self.teraflops_arguments = dict()
+    self.daemon = None
+    self.inventory = None
 
   def generate_arguments_json(self):
     tf_data_dir = os.getenv('TF_DATA_DIR', '.terraform')
     tf_cache_file = os.path.join(tf_data_dir, 'teraflops.json')
+    workdir = self.state.workdir or os.getcwd()
 
     # if we already have a cached .tf.json file don't bother generating one
-    if self.config == '.' and os.path.isfile(tf_cache_file):
-      shutil.copy(tf_cache_file, 'main.tf.json')
+    if os.path.isfile(tf_cache_file):
+      shutil.copy(tf_cache_file, os.path.join(workdir, 'main.tf.json'))
 
-      process = subprocess.run([self.terraform, 'show', '-json'], stdout=subprocess.PIPE, check=True)
-      data = json.loads(process.stdout)
+      self.state.load()
 
       with contextlib.suppress(FileNotFoundError):
-        os.remove('main.tf.json')
+        os.remove(os.path.join(workdir, 'main.tf.json'))
     else:
-      with tempfile.NamedTemporaryFile(mode='w', dir=os.getcwd(), prefix='teraflops', suffix='.tf.json') as fp:
+      with tempfile.NamedTemporaryFile(mode='w', dir=workdir, prefix='teraflops', suffix='.tf.json') as fp:
         # generate a minimal .tf.json file which can be used to run 'terraform show -json'
-        subprocess.run(['nix-instantiate', '--eval', '--json', '--strict', '--read-write-mode', self.generate_bootstrap_nix()], stdout=fp, check=True)
+        tracer.run(['nix-instantiate', '--eval', '--json', '--strict', '--read-write-mode', self.generate_bootstrap_nix()], stdout=fp, check=True)
 
-        process = subprocess.run([self.terraform, 'show', '-json'], stdout=subprocess.PIPE, check=True)
-        data = json.loads(process.stdout)
+        self.state.load()
 
-    try:
-      resources = data['values']['root_module']['resources']
-      for resource in resources:
-        if resource['address'] == 'terraform_data.teraflops-arguments':
-          self.teraflops_arguments = resource['values']['input']
-    except KeyError:
-      pass
+    self.teraflops_arguments = self.state.arguments()
 
     with open(os.path.join(self.tempdir, 'arguments.json'), 'w') as fp:
-      fp.write(json.dumps(self.teraflops_arguments, indent=2, sort_keys=True))
+      fp.write(json.dumps(self.teraflops_arguments, separators=(',', ':'), sort_keys=True))
 
-  def generate_terraform_json(self, need_tf_file=True):
-    if need_tf_file:
-      self.generate_main_tf_json(refresh=False)
+  def terraform_data(self, need_tf_file=True):
+    if self.daemon:
+      return self.daemon.request('terraform')
 
-    process = subprocess.run([self.terraform, 'show', '-json'], stdout=subprocess.PIPE, check=True)
-    terraform_data = json.loads(process.stdout)
+    if need_tf_file and not self.state.loaded:
+      self.generate_main_tf_json(refresh=False)
 
-    try:
-      outputs = terraform_data['values']['outputs']
-      resources = terraform_data['values']['root_module']['resources']
-    except KeyError:
-      resources = dict()
-      outputs = dict()
+    return dict(outputs=self.state.outputs(), resources=self.state.resources())
 
-    resources_data = dict()
-    for resource in resources:
-      inner = resources_data.setdefault(resource['type'], dict())
+  # nix is the only consumer of these files so keep them compact, which is considerably faster for large states, and
+  # split the resources by type so an evaluation only ever parses the types it refers to (see state.nix)
+  def write_terraform_json(self, data):
+    resources_dir = os.path.join(self.tempdir, 'terraform')
+    shutil.rmtree(resources_dir, ignore_errors=True)
+    os.makedirs(resources_dir)
 
-      if resource.get('index') is not None:
-        if type(resource.get('index')) == int:
-          offset = int(resource.get('index'))
-          index = inner.setdefault(resource['name'], list())
-          index += [None] * ((offset + 1) - len(index))
-          index.insert(offset, resource['values'])
-        else:
-          index = inner.setdefault(resource['name'], dict())
-          index[resource['index']] = resource['values']
-      else:
-        inner[resource['name']] = resource['values']
+    for type_, resources in data['resources'].items():
+      # modules decode the result of their node's ssh_resource, do it once here instead of in every evaluation
+      if type_ == 'ssh_resource':
+        resources = {name: decode_result(values) for name, values in resources.items()}
 
-    outputs_data = dict()
-    for key, value in outputs.items():
-      outputs_data[key] = value['value']
+      with open(os.path.join(resources_dir, f'{type_}.json'), 'w') as f:
+        f.write(json.dumps(resources, separators=(',', ':')))
 
     with open(os.path.join(self.tempdir, 'terraform.json'), 'w') as f:
-      f.write(json.dumps(dict(outputs=outputs_data, resources=resources_data), indent=2, sort_keys=True))
+      f.write(json.dumps(dict(outputs=data['outputs'], types=sorted(data['resources'])), separators=(',', ':')))
+
+    with open(os.path.join(self.tempdir, 'state.nix'), 'w') as f:
+      f.write(files('teraflops.nix').joinpath('state.nix').read_text())
+
+  def generate_terraform_json(self, need_tf_file=True):
+    self.write_terraform_json(self.terraform_data(need_tf_file))
+
+    if self.daemon:
+      return os.path.join(self.tempdir, 'terraform.json')
 
     if not os.environ.get('SSH_CONFIG_FILE'):
       try:
-        private_key = outputs['teraflops']['value']['privateKey']
-      except KeyError:
+        private_key = self.state.teraflops()['privateKey']
+      except (KeyError, TypeError):
         private_key = None
 
       if private_key is not None:
@@ -193,10 +1043,7 @@ class App:
     return os.path.join(self.tempdir, 'terraform.json')
 
   def generate_bootstrap_nix(self):
-    process = subprocess.run(['nix', '--extra-experimental-features', 'nix-command', 'flake', 'metadata', '--json', self.config], stdout=subprocess.PIPE, check=True)
-    metadata = json.loads(process.stdout)
-
-    flake = metadata['resolvedUrl']
+    flake = self.flake.resolved_url()
 
     bootstrap_nix = files('teraflops.nix').joinpath('bootstrap.nix').read_text()
 
@@ -206,10 +1053,7 @@ class App:
     return os.path.join(self.tempdir, 'bootstrap.nix')
 
   def generate_eval_nix(self):
-    process = subprocess.run(['nix', '--extra-experimental-features', 'nix-command', 'flake', 'metadata', '--json', self.config], stdout=subprocess.PIPE, check=True)
-    metadata = json.loads(process.stdout)
-
-    flake = metadata['resolvedUrl']
+    flake = self.flake.resolved_url()
 
     eval_nix = files('teraflops.nix').joinpath('eval.nix').read_text()
 
@@ -243,12 +1087,46 @@ class App:
 
     return os.path.join(self.tempdir, 'repl.nix')
 
-  # NOTE: only cache/use cached main.tf.json if no --config is specified
+  # digest of everything which goes into main.tf.json: the locked flake, the deployment arguments, any
+  # terraform state handed to the evaluation and the nix sources shipped with teraflops itself
+  def main_tf_json_key(self):
+    nar_hash = self.flake.metadata().get('locked', {}).get('narHash')
+    if nar_hash is None:
+      return None
+
+    digest = hashlib.sha256()
+    digest.update(nar_hash.encode())
+    digest.update(json.dumps(self.teraflops_arguments, sort_keys=True).encode())
+
+    with contextlib.suppress(FileNotFoundError):
+      with open(os.path.join(self.tempdir, 'terraform.json'), 'rb') as fp:
+        digest.update(fp.read())
+
+      for name in sorted(os.listdir(os.path.join(self.tempdir, 'terraform'))):
+        with open(os.path.join(self.tempdir, 'terraform', name), 'rb') as fp:
+          digest.update(name.encode())
+          digest.update(fp.read())
+
+    def walk(path):
+      for child in sorted(path.iterdir(), key=lambda child: child.name):
+        if child.is_dir():
+          yield from walk(child)
+        else:
+          yield child
+
+    for source in walk(files('teraflops.nix')):
+      digest.update(source.name.encode())
+      digest.update(source.read_bytes())
+
+    return digest.hexdigest()
+
   def generate_main_tf_json(self, refresh: bool, rewrite_args=False):
     tf_data_dir = os.getenv('TF_DATA_DIR', '.terraform')
     tf_cache_file = os.path.join(tf_data_dir, 'teraflops.json')
+    tf_cache_dir = os.path.join(tf_data_dir, 'teraflops')
 
-    if not refresh and self.config == '.' and os.path.isfile(tf_cache_file):
+    # `teraflops.json` is the most recently generated main.tf.json, which is good enough when we don't need a fresh one
+    if not refresh and os.path.isfile(tf_cache_file):
       if rewrite_args:
         with open(tf_cache_file, 'r') as fp:
           data = json.load(fp)
@@ -256,7 +1134,6 @@ class App:
         data.setdefault('resource', dict())
         data['resource'].setdefault('terraform_data', dict())
         data['resource']['terraform_data'].setdefault('teraflops-arguments', dict())
-        data['resource']['terraform_data']['teraflops-arguments'].setdefault('input', dict())
         data['resource']['terraform_data']['teraflops-arguments']['input'] = self.teraflops_arguments
 
         with open('main.tf.json', 'w') as fp:
@@ -265,33 +1142,166 @@ class App:
         shutil.copy(tf_cache_file, 'main.tf.json')
       return
 
-    self.generate_hive_nix(full_eval=False)
+    key = self.main_tf_json_key()
+    cache_entry = os.path.join(tf_cache_dir, '%s.tf.json' % key) if key else None
 
-    cmd = ['nix-build', '--quiet']
-    if self.show_trace:
-      cmd += ['--show-trace']
-    cmd += ['--out-link', 'main.tf.json', self.generate_terraform_nix()]
+    if cache_entry and os.path.isfile(cache_entry):
+      logging.debug(f'main.tf.json cache hit ({key})')
 
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+      # mark the entry as recently used so it survives eviction
+      os.utime(cache_entry)
+      shutil.copy(cache_entry, 'main.tf.json')
+    else:
+      if key:
+        logging.debug(f'main.tf.json cache miss ({key})')
+      else:
+        logging.debug('main.tf.json cache miss (flake has no narHash)')
 
-    if self.config == '.':
-      os.makedirs(tf_data_dir, exist_ok=True)
-      shutil.copy('main.tf.json', tf_cache_file)
-      os.chmod(tf_cache_file, 0o664)
+      self.generate_hive_nix(full_eval=False)
 
-  def query_deployment(self, need_tf_file=True):
-    if need_tf_file:
-      self.generate_main_tf_json(refresh=False)
+      cmd = ['nix-build', '--quiet']
+      if self.show_trace:
+        cmd += ['--show-trace']
+      cmd += ['--out-link', 'main.tf.json', self.generate_terraform_nix()]
+
+      # a flake whose terraform code needs full NixOS systems fails the lightweight evaluation every time, so a failure
+      # is remembered next to the cache entries and the lightweight evaluation is only tried once per flake revision
+      nar_hash = self.flake.metadata().get('locked', {}).get('narHash')
+      full_marker = os.path.join(tf_cache_dir, '%s.full' % hashlib.sha256(nar_hash.encode()).hexdigest()) if nar_hash else None
 
-    process = subprocess.run([self.terraform, 'output', '-json', 'teraflops'], capture_output=True)
+      if full_marker and os.path.isfile(full_marker):
+        logging.debug('lightweight evaluation failed before for this flake, using a full evaluation of every node')
 
+        # mark the marker as recently used so it survives eviction
+        os.utime(full_marker)
+        tracer.run(cmd, stdout=subprocess.DEVNULL, check=True)
+      else:
+        # try without evaluating full NixOS systems first, which only works when terraform code sticks to `deployment.*`
+        process = tracer.run(cmd + ['--arg', 'lightweight', 'true'], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+          logging.debug('lightweight evaluation failed, falling back to a full evaluation of every node')
+          logging.debug(process.stderr.decode().rstrip())
+
+          tracer.run(cmd, stdout=subprocess.DEVNULL, check=True)
+
+          if full_marker:
+            os.makedirs(tf_cache_dir, exist_ok=True)
+            open(full_marker, 'w').close()
+
+      if cache_entry:
+        os.makedirs(tf_cache_dir, exist_ok=True)
+        shutil.copy('main.tf.json', cache_entry)
+        os.chmod(cache_entry, 0o664)
+
+        # evict the least recently used entries
+        entries = sorted((os.path.join(tf_cache_dir, entry) for entry in os.listdir(tf_cache_dir)), key=os.path.getmtime, reverse=True)
+        for entry in entries[self.main_tf_json_cache_size:]:
+          with contextlib.suppress(FileNotFoundError):
+            os.remove(entry)
+
+    os.makedirs(tf_data_dir, exist_ok=True)
     with contextlib.suppress(FileNotFoundError):
-      os.remove('main.tf.json')
+      os.remove(tf_cache_file)
+    shutil.copy('main.tf.json', tf_cache_file)
+    os.chmod(tf_cache_file, 0o664)
 
+  # the `teraflops` output is all ssh, scp, check, reboot and ssh-for-each need, keep a copy around to skip terraform
+  def inventory_file(self):
+    return os.path.join(os.getenv('TF_DATA_DIR', '.terraform'), 'teraflops-inventory.json')
+
+  def load_inventory(self):
     try:
-      output = json.loads(process.stdout)
-    except:
-      process = subprocess.run(['colmena', '--config', self.generate_hive_nix(full_eval=True), 'eval', '-E', '{ nodes, pkgs, lib }: { privateKey = null; nodes = lib.mapAttrs (_: node: { inherit (node.config.deployment) provisionSSHKey tags targetEnv targetHost targetPort targetUser; }) nodes; }'], stdout=subprocess.PIPE, check=True)
+      with open(self.inventory_file(), 'r') as fp:
+        data = json.load(fp)
+    except (FileNotFoundError, ValueError):
+      return None
+
+    if data.get('config') != os.path.abspath(self.config):
+      return None
+
+    serial = state_serial()
+    if serial is not None:
+      if data.get('serial') != serial:
+        logging.debug('node inventory is stale (state serial changed)')
+        return None
+    elif time.time() - data.get('written', 0) > self.inventory_ttl:
+      logging.debug('node inventory is stale (older than %ds)' % self.inventory_ttl)
+      return None
+
+    logging.debug('using cached node inventory')
+    return data['teraflops']
+
+  def save_inventory(self, output):
+    with contextlib.suppress(FileNotFoundError):
+      os.remove(self.inventory_file())
+
+    if output is None:
+      return
+
+    os.makedirs(os.path.dirname(self.inventory_file()), exist_ok=True)
+
+    # this contains the private key, just like the state it came from
+    with open(self.inventory_file(), mode='w', opener=lambda path, flags: os.open(path, flags, 0o600)) as fp:
+      json.dump(dict(config=os.path.abspath(self.config), serial=state_serial(), written=time.time(), teraflops=output), fp)
+
+  # facts collected by `teraflops facts`, each node's are timestamped so readers can decide how old is too old
+  def facts_file(self):
+    return os.path.join(os.getenv('TF_DATA_DIR', '.terraform'), 'teraflops-facts.json')
+
+  def load_facts(self, ttl=None):
+    try:
+      with open(self.facts_file(), 'r') as fp:
+        data = json.load(fp)
+    except (FileNotFoundError, ValueError):
+      return dict()
+
+    now = time.time()
+    return {name: facts for name, facts in data.items() if ttl is None or now - facts.get('collected', 0) <= ttl}
+
+  # `facts` are merged into what is cached already, `forget` removes nodes whose facts are known to have changed
+  def save_facts(self, facts=None, forget=()):
+    data = self.load_facts()
+    if not facts and not any(name in data for name in forget):
+      return
+
+    data.update(facts or dict())
+    for name in forget:
+      data.pop(name, None)
+
+    os.makedirs(os.path.dirname(self.facts_file()), exist_ok=True)
+
+    # readers never see a partially written file
+    with open(self.facts_file() + '.tmp', 'w') as fp:
+      json.dump(data, fp)
+    os.replace(self.facts_file() + '.tmp', self.facts_file())
+
+  def query_deployment(self, need_tf_file=True):
+    if self.daemon:
+      response = self.daemon.request('nodes')
+
+      # the private key lives in the tempdir of the daemon
+      if response['ssh_config'] and not os.environ.get('SSH_CONFIG_FILE'):
+        os.environ['SSH_CONFIG_FILE'] = response['ssh_config']
+
+      return response['nodes']
+
+    if self.inventory is not None:
+      output = self.inventory
+    else:
+      if need_tf_file and not self.state.loaded:
+        self.generate_main_tf_json(refresh=False)
+
+      output = self.state.teraflops()
+      if output is not None:
+        self.save_inventory(output)
+
+      # the main.tf.json of the project directory is never ours to remove with a private working directory
+      if not self.state.workdir:
+        with contextlib.suppress(FileNotFoundError):
+          os.remove('main.tf.json')
+
+    if output is None:
+      process = tracer.run(['colmena', '--config', self.generate_hive_nix(full_eval=True), 'eval', '-E', '{ nodes, pkgs, lib }: { privateKey = null; nodes = lib.mapAttrs (_: node: { inherit (node.config.deployment) provisionSSHKey tags targetEnv targetHost targetPort targetUser; }) nodes; }'], stdout=subprocess.PIPE, check=True)
       output = json.loads(process.stdout)
 
     if not os.environ.get('SSH_CONFIG_FILE'):
@@ -305,16 +1315,143 @@ class App:
 
     return output['nodes']
 
+  def scheduler(self, args):
+    return Scheduler(args.parallel, args.tag_limit, args.fail_fast)
+
+  # mtimes of everything which may change the deployment, local terraform state included
+  def fingerprint(self):
+    entries = list()
+
+    if os.path.isdir(self.config):
+      for root, dirs, filenames in os.walk(self.config):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d != 'result']
+        for filename in filenames:
+          if filename.endswith('.nix') or filename == 'flake.lock':
+            st = os.stat(os.path.join(root, filename))
+            entries.append((os.path.join(root, filename), st.st_mtime_ns, st.st_size))
+
+    for path in ['terraform.tfstate', os.path.join(os.getenv('TF_DATA_DIR', '.terraform'), 'terraform.tfstate')]:
+      with contextlib.suppress(FileNotFoundError):
+        st = os.stat(path)
+        entries.append((path, st.st_mtime_ns, st.st_size))
+
+    return hash(tuple(sorted(entries)))
+
+  # reading the state and resolving the flake don't depend on each other, only bootstrapping without a cached
+  # main.tf.json needs the flake to read the state
+  def prepare(self, arguments=True, metadata=False):
+    graph = TaskGraph()
+    graph.add('flake', self.flake.resolved_url)
+
+    # the narHash is needed to regenerate main.tf.json, get it while terraform reads the state
+    if metadata:
+      graph.add('flake metadata', self.flake.metadata)
+
+    if arguments:
+      bootstrapped = os.path.isfile(os.path.join(os.getenv('TF_DATA_DIR', '.terraform'), 'teraflops.json'))
+      graph.add('arguments', self.generate_arguments_json, after=[] if bootstrapped else ['flake'])
+
+    graph.add('eval.nix', self.generate_eval_nix, after=['flake'])
+    graph.run()
+
+  # `serve` reads the state while other commands write and remove main.tf.json in the project directory, so terraform
+  # runs in a private working directory which shares everything but the configuration with the project directory
+  def private_workdir(self):
+    workdir = os.path.join(self.tempdir, 'workdir')
+    os.makedirs(workdir, exist_ok=True)
+
+    # local state and the lock file may only appear after `serve` started
+    for filename in ['.terraform.lock.hcl', 'terraform.tfstate', 'terraform.tfstate.d']:
+      link = os.path.join(workdir, filename)
+      if os.path.exists(filename) and not os.path.lexists(link):
+        os.symlink(os.path.abspath(filename), link)
+
+    return workdir
+
+  def reload(self):
+    logging.info('Loading deployment..')
+
+    # start over with a fresh key in case it was rotated
+    os.environ.pop('SSH_CONFIG_FILE', None)
+    shutil.rmtree(os.path.join(self.tempdir, '.ssh'), ignore_errors=True)
+
+    self.state.invalidate()
+    self.state.workdir = self.private_workdir()
+    self.flake = FlakeResolver(self.config)
+
+    self.prepare()
+    self.generate_terraform_json(need_tf_file=False)
+    self.nodes = self.query_deployment(need_tf_file=False)
+
+  def serve(self, args):
+    path = daemon_socket()
+    loaded = dict(fingerprint=None, at=0)
+
+    def handle(request):
+      if request['command'] == 'hello':
+        return dict(config=os.path.abspath(self.config))
+
+      # remote state can't be watched so it is also reloaded every so often
+      fingerprint = self.fingerprint()
+      if fingerprint != loaded['fingerprint'] or time.monotonic() - loaded['at'] > args.state_ttl:
+        self.reload()
+        loaded.update(fingerprint=fingerprint, at=time.monotonic())
+
+      if request['command'] == 'nodes':
+        return dict(nodes=self.nodes, ssh_config=os.environ.get('SSH_CONFIG_FILE'))
+      elif request['command'] == 'terraform':
+        return dict(outputs=self.state.outputs(), resources=self.state.resources())
+      elif request['command'] == 'eval':
+        return dict(results=self.evaluate(request['exprs'], request.get('batch_size'), request.get('parallel'), request.get('show_trace'), capture_stderr=True))
+      else:
+        raise DaemonError(f'unknown command "{request["command"]}"')
+
+    class Handler(socketserver.StreamRequestHandler):
+      def handle(self):
+        # every request gets a response, the client can't tell what went wrong otherwise
+        try:
+          response = handle(json.loads(self.rfile.readline()))
+        except subprocess.CalledProcessError as e:
+          error = f'{os.path.basename(e.cmd[0])} failed with exit code {e.returncode}'
+          if e.stderr:
+            error += ':\n' + e.stderr.decode(errors='replace').rstrip()
+
+          logging.error(error)
+          response = dict(error=error)
+        except Exception as e:
+          logging.error(str(e))
+          response = dict(error=str(e) or type(e).__name__)
+
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+    with contextlib.suppress(FileNotFoundError):
+      os.remove(path)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with socketserver.UnixStreamServer(path, Handler) as server:
+      os.chmod(path, 0o600)
+      logging.info(f'Listening on {path}')
+
+      try:
+        server.serve_forever()
+      finally:
+        with contextlib.suppress(FileNotFoundError):
+          os.remove(path)
+
   def tf(self, args):
     self.generate_main_tf_json(refresh=True)
-    subprocess.run([self.terraform] + args.passthru, check=True)
+
+    # there is no telling what the passthru did to the state
+    self.save_inventory(None)
+    tracer.run([self.terraform] + args.passthru, check=True)
 
   def nix(self, args):
     if '--config' in args.passthru:
       logging.fatal('cannot pass through --config argument to colmena')
       sys.exit(1)
 
-    subprocess.run(['colmena', '--config', self.generate_hive_nix(full_eval=True)] + args.passthru, check=True)
+    tracer.run(['colmena', '--config', self.generate_hive_nix(full_eval=True)] + args.passthru, check=True)
 
   def init(self, args):
     cmd = [self.terraform, 'init']
@@ -327,8 +1464,8 @@ class App:
 
     with tempfile.NamedTemporaryFile(mode='w', dir=os.getcwd(), prefix='teraflops', suffix='.tf.json') as fp:
       # generate a minimal .tf.json file which can be used to run 'terraform init'
-      subprocess.run(['nix-instantiate', '--eval', '--json', '--strict', '--read-write-mode', self.generate_bootstrap_nix()], stdout=fp, check=True)
-      subprocess.run(cmd, check=True)
+      tracer.run(['nix-instantiate', '--eval', '--json', '--strict', '--read-write-mode', self.generate_bootstrap_nix()], stdout=fp, check=True)
+      tracer.run(cmd, check=True)
 
   def repl(self, args):
     self.generate_hive_nix(full_eval=True)
@@ -342,45 +1479,122 @@ class App:
     with contextlib.suppress(FileNotFoundError):
       os.remove('main.tf.json')
 
-    subprocess.run(cmd, check=True)
+    tracer.run(cmd, check=True)
 
-  def eval(self, args):
+  # evaluates a list of expressions against the complete configuration, returning their results in order
+  # with `capture_stderr` errors of colmena are raised with its stderr instead of it going to ours (see `serve`)
+  def evaluate(self, exprs, batch_size=None, parallel=None, show_trace=False, capture_stderr=False):
     hive_nix = self.generate_hive_nix(full_eval=True)
 
-    async def colmena_eval(expr):
+    # every expression in a batch shares a single evaluation of the hive, results come back as a list in order
+    async def colmena_eval(exprs):
       cmd = ['colmena', '--config', hive_nix, 'eval']
-      if args.show_trace:
+      if show_trace:
         cmd += ['--show-trace']
       # TODO: make `terraform` variable inaccessible from within expression
-      cmd += ['-E', 'let terraform = with builtins; fromJSON (readFile %s); arguments = with builtins; fromJSON (readFile %s); f = %s; in { nodes, pkgs, lib }: f ({ inherit nodes pkgs lib; inherit (terraform) outputs resources; } // arguments)' % (os.path.join(self.tempdir, 'terraform.json'), os.path.join(self.tempdir, 'arguments.json'), expr)]
+      cmd += ['-E', 'let terraform = import %s; arguments = with builtins; fromJSON (readFile %s); in { nodes, pkgs, lib }: let args = { inherit nodes pkgs lib; inherit (terraform) outputs resources; } // arguments; in [ %s ]' % (os.path.join(self.tempdir, 'state.nix'), os.path.join(self.tempdir, 'arguments.json'), ' '.join('((%s) args)' % expr for expr in exprs))]
 
-      process = await asyncio.create_subprocess_exec(*cmd)
-      _, _ = await process.communicate()
+      async with limit:
+        process = await tracer.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE if capture_stderr else None)
+        stdout, stderr = await process.communicate()
 
       if process.returncode != 0:
-        raise Exception(process.stderr)
+        raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+
+      return json.loads(stdout)
+
+    batch_size = batch_size or len(exprs)
+    batches = [exprs[i:i + batch_size] for i in range(0, len(exprs), batch_size)]
+    limit = asyncio.Semaphore(parallel or len(batches))
 
     async def run():
       try:
         async with asyncio.TaskGroup() as tg:
-          tasks = [tg.create_task(colmena_eval(expr)) for expr in args.expr]
-      except:
-        sys.exit(1)
+          tasks = [tg.create_task(colmena_eval(batch)) for batch in batches]
+      except ExceptionGroup as e:
+        raise e.exceptions[0]
 
-    asyncio.run(run())
+      return [result for task in tasks for result in task.result()]
 
-  def deploy(self, args):
-    # apply
+    return asyncio.run(run())
+
+  # the system each node would be switched to, outPath is known after evaluation alone so nothing is built
+  def toplevels(self, names):
+    expr = '{ nodes, lib, ... }: lib.mapAttrs (_: node: node.config.system.build.toplevel.outPath) (builtins.intersectAttrs (lib.genAttrs [ %s ] (_: null)) nodes)' % ' '.join(json.dumps(name) for name in names)
+
+    return self.evaluate([expr], show_trace=self.show_trace)[0]
+
+  # names of the nodes which already run the system they would be switched to, in a single parallel ssh sweep
+  def unchanged_nodes(self, nodes, parallel=None):
+    toplevels = self.toplevels(nodes)
+    unchanged = list()
+
+    async def compare(name, node):
+      if await current_system(node) == toplevels.get(name):
+        unchanged.append(name)
+
+    asyncio.run(Scheduler(parallel).run(nodes, compare))
+
+    return unchanged
+
+  def eval(self, args):
+    if self.daemon:
+      results = self.daemon.request('eval', exprs=args.expr, batch_size=args.batch_size, parallel=args.parallel, show_trace=args.show_trace)['results']
+    else:
+      results = self.evaluate(args.expr, args.batch_size, args.parallel, args.show_trace)
+
+    for result in results:
+      print(json.dumps(result, separators=(',', ':')))
+
+  # the apply part of `deploy`, limited to the resources of the selected nodes if there is a filter
+  def terraform_apply(self, args):
     self.generate_main_tf_json(refresh=True)
 
     cmd = [self.terraform, 'apply']
     if args.confirm:
       cmd += ['-auto-approve']
 
-    subprocess.run(cmd, check=True)
+    # only refresh and apply what belongs to the selected nodes
+    if args.on and not args.no_target:
+      with open('main.tf.json', 'r') as fp:
+        main_tf = json.load(fp)
+
+      nodes = NodeFilter(args.on).filter(main_tf.get('output', {}).get('teraflops', {}).get('value', {}).get('nodes') or dict())
+      targets = node_targets(main_tf, nodes)
+
+      if 'teraflops-arguments' in main_tf.get('resource', {}).get('terraform_data', {}):
+        targets.append('terraform_data.teraflops-arguments')
+
+      if not targets:
+        logging.info('No terraform resources belong to the selected nodes, skipping apply.')
+        return
+
+      logging.debug(f'targeting {len(targets)} terraform resource(s) of {len(nodes)} node(s)')
+      cmd += [f'-target={target}' for target in targets]
+
+    tracer.run(cmd, check=True)
+    self.state.invalidate()
+
+  def deploy(self, args):
+    # the state as it was before the apply, to tell which nodes it touched
+    before = {resource['address']: resource['values'] for resource in self.state.raw_resources()} if args.facts_ttl is not None else dict()
+
+    # apply
+    if args.plan:
+      self.apply_plan(args.plan)
+    else:
+      self.terraform_apply(args)
 
     self.generate_terraform_json(need_tf_file=False)
 
+    # facts of a node whose resources the apply changed may well describe a machine which has just been replaced
+    if args.facts_ttl is not None:
+      after = {resource['address']: resource for resource in self.state.raw_resources()}
+      touched = {resource['name'] for address, resource in after.items() if before.get(address) != resource['values']}
+      touched.update(address.partition('[')[0].rpartition('.')[2] for address in before if address not in after)
+
+      self.save_facts(forget=touched)
+
 
     # make sure all relevant nodes are available
     nodes = self.query_deployment(need_tf_file=False)
@@ -391,96 +1605,246 @@ class App:
 
     length = len(max(nodes.keys(), key = len)) if nodes else len('ERROR')
 
-    ssh_args = ['-o', 'ConnectTimeout=10'] # see https://github.com/zhaofengli/colmena/issues/166#issuecomment-1892325999
+    hive_nix = self.generate_hive_nix(full_eval=False)
+
+    def colmena_apply(on):
+      cmd = ['colmena', '--config', hive_nix, 'apply']
+      if args.show_trace:
+        cmd += ['--show-trace']
+      if args.verbose:
+        cmd += ['--verbose']
+      if on:
+        cmd += ['--on', on]
+      cmd += ['--evaluator', 'streaming']
+      if not (args.eval_node_limit is None):
+        cmd += ['--eval-node-limit', str(args.eval_node_limit)]
+      if not (args.parallel is None):
+        cmd += ['--parallel', str(args.parallel)]
+      if args.reboot:
+        cmd += ['boot', '--reboot']
+      else:
+        cmd += ['switch']
+
+      return cmd
+
+    toplevels = self.toplevels(nodes) if args.skip_unchanged and nodes else None
+    unchanged = list()
+
+    # nodes which reported facts recently enough, and weren't touched by the apply, are taken to be reachable
+    facts = self.load_facts(args.facts_ttl) if args.facts_ttl is not None else dict()
+
+    waiter = NodeWaiter(args.wait_timeout)
+
+    # colmena draws its own progress, don't fight over the terminal with it
+    if args.pipeline:
+      waiter.live = False
+
+    ready = asyncio.Queue()
+
+    async def reachable(node):
+      return await boot_id(node) is not None
 
     async def wait_for_node(name, node):
-      # TODO: mimic colmena spinners to let user know that we're waiting for nodes to become available
-      while True:
-        proc = await asyncio.create_subprocess_exec(*ssh(node, ['cat', '/proc/sys/kernel/random/boot_id'], ssh_args), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+      if name in facts or await waiter.wait(name, node, reachable):
+        if toplevels and (facts[name]['system'] if name in facts else await current_system(node)) == toplevels.get(name):
+          waiter.print(colored(name.ljust(length), color='green', attrs=['bold']), '|', colored('Unchanged', color='green'))
+          unchanged.append(name)
+          return True
+
+        waiter.print(colored(name.ljust(length), color='green', attrs=['bold']), '|', colored('Ready', color='green'))
+        ready.put_nowait(name)
+        return True
+
+      waiter.print(colored(name.ljust(length), color='red', attrs=['bold']), '|', colored('Timed out', color='red'))
+      return False
+
+    # activate nodes in batches while the rest are still being waited on, every node which became
+    # ready while colmena was busy with the previous batch goes into the next one
+    async def activate_ready():
+      returncode = 0
+      done = False
 
-        if await proc.wait() == 0:
-          break
+      while not done:
+        batch = [await ready.get()]
+        while not ready.empty():
+          batch.append(ready.get_nowait())
 
-        await asyncio.sleep(2)
+        done = None in batch
+        batch = [name for name in batch if name is not None]
+        if not batch:
+          continue
+
+        logging.info(f'Activating {len(batch)} ready node(s)..')
+
+        proc = await tracer.create_subprocess_exec(*colmena_apply(','.join(batch)))
+        returncode = await proc.wait() or returncode
+
+      return returncode
 
     async def run():
+      activation = asyncio.create_task(activate_ready()) if args.pipeline else None
+
       tasks = [wait_for_node(name, node) for name, node in nodes.items()]
-      return await asyncio.gather(*tasks)
+      available = await asyncio.gather(*tasks)
+
+      ready.put_nowait(None)
+      return all(available), await activation if activation else 0
+
+    available, returncode = asyncio.run(run())
+
+    if returncode:
+      sys.exit(returncode)
 
-    asyncio.run(run())
+    if not available:
+      logging.error('Some nodes did not become available in time.')
+      sys.exit(1)
+
+    if unchanged:
+      logging.info(f'Skipped {len(unchanged)} unchanged node(s).')
+
+    # whatever gets activated now will report a different system
+    self.save_facts(forget=[name for name in nodes if name not in unchanged])
 
 
     # activate
-    cmd = ['colmena', '--config', self.generate_hive_nix(full_eval=False), 'apply']
-    if args.show_trace:
-      cmd += ['--show-trace']
-    if args.verbose:
-      cmd += ['--verbose']
-    if args.on:
-      cmd += ['--on', args.on]
-    cmd += ['--evaluator', 'streaming']
-    if not (args.eval_node_limit is None):
-      cmd += ['--eval-node-limit', str(args.eval_node_limit)]
-    if not (args.parallel is None):
-      cmd += ['--parallel', str(args.parallel)]
-    if args.reboot:
-      cmd += ['boot', '--reboot']
-    else:
-      cmd += ['switch']
+    if not args.pipeline:
+      changed = [name for name in nodes if name not in unchanged]
+      if not changed:
+        return
+
+      # colmena doesn't understand every filter teraflops does, hand it the selected nodes instead
+      tracer.run(colmena_apply(','.join(changed) if args.on or unchanged else None), check=True)
+
+  # a saved plan is accompanied by the hash of the main.tf.json it was made from, see `plan --out`
+  @staticmethod
+  def plan_hash_file(path):
+    return f'{path}.teraflops.json'
+
+  @staticmethod
+  def main_tf_json_hash():
+    with open('main.tf.json', 'rb') as fp:
+      return hashlib.sha256(fp.read()).hexdigest()
+
+  # applies a saved plan as is, the most recently generated main.tf.json must be the one it was made from
+  def apply_plan(self, path):
+    try:
+      with open(self.plan_hash_file(path), 'r') as fp:
+        expected = json.load(fp)['main_tf_json']
+    except (FileNotFoundError, ValueError, KeyError):
+      logging.error(f'{path} was not created by `teraflops plan --out`')
+      sys.exit(1)
 
-    subprocess.run(cmd, check=True)
+    self.generate_main_tf_json(refresh=False)
+
+    if self.main_tf_json_hash() != expected:
+      logging.error(f'the configuration changed since {path} was created, run `teraflops plan --out {path}` again')
+      sys.exit(1)
+
+    tracer.run([self.terraform, 'apply', path], check=True)
+    self.state.invalidate()
 
   def plan(self, args):
     self.generate_main_tf_json(refresh=True)
-    subprocess.run([self.terraform, 'plan'], check=True)
+
+    cmd = [self.terraform, 'plan']
+    if args.out:
+      cmd += [f'-out={args.out}']
+
+    tracer.run(cmd, check=True)
+
+    if args.out:
+      with open(self.plan_hash_file(args.out), 'w') as fp:
+        json.dump(dict(main_tf_json=self.main_tf_json_hash()), fp)
 
   def apply(self, args):
-    self.generate_main_tf_json(refresh=True)
+    if args.plan:
+      self.apply_plan(args.plan)
+    else:
+      self.generate_main_tf_json(refresh=True)
 
-    cmd = [self.terraform, 'apply']
-    if args.confirm:
-      cmd += ['-auto-approve']
+      cmd = [self.terraform, 'apply']
+      if args.confirm:
+        cmd += ['-auto-approve']
 
-    subprocess.run(cmd, check=True)
+      tracer.run(cmd, check=True)
+      self.state.invalidate()
+
+    self.save_inventory(self.state.teraflops())
+
+  # the nodes terraform knows about which --on selects, selecting none of them is an error
+  def selected_nodes(self, on):
+    nodes = NodeFilter(on).filter(self.query_deployment())
+    if not nodes:
+      logging.error('No hosts selected (0 skipped).')
+      sys.exit(1)
+
+    return nodes
+
+  # colmena doesn't understand `&` or `!`, only filters using them are resolved to the names of the selected nodes
+  # as that limits them to nodes which have been applied already
+  def colmena_on(self, on):
+    if not on or not any('&' in term or term.strip().startswith('!') for term in on.split(',')):
+      return on
+
+    return ','.join(self.selected_nodes(on))
 
   def build(self, args):
+    on = self.colmena_on(args.on)
+
     cmd = ['colmena', '--config', self.generate_hive_nix(full_eval=True), 'apply']
     if args.show_trace:
       cmd += ['--show-trace']
     if args.verbose:
       cmd += ['--verbose']
-    if args.on:
-      cmd += ['--on', args.on]
+    if on:
+      cmd += ['--on', on]
     cmd += ['--evaluator', 'streaming']
     if not (args.eval_node_limit is None):
       cmd += ['--eval-node-limit', str(args.eval_node_limit)]
     cmd += ['build']
-    subprocess.run(cmd, check=True)
+    tracer.run(cmd, check=True)
 
   def push(self, args):
+    on = self.colmena_on(args.on)
+
     cmd = ['colmena', '--config', self.generate_hive_nix(full_eval=True), 'apply']
     if args.show_trace:
       cmd += ['--show-trace']
     if args.verbose:
       cmd += ['--verbose']
-    if args.on:
-      cmd += ['--on', args.on]
+    if on:
+      cmd += ['--on', on]
     cmd += ['--evaluator', 'streaming']
     if not (args.eval_node_limit is None):
       cmd += ['--eval-node-limit', str(args.eval_node_limit)]
     if not (args.parallel is None):
       cmd += ['--parallel', str(args.parallel)]
     cmd += ['push']
-    subprocess.run(cmd, check=True)
+    tracer.run(cmd, check=True)
 
   def activate(self, args):
+    if args.skip_unchanged:
+      nodes = self.selected_nodes(args.on) if args.on else self.query_deployment()
+
+      unchanged = self.unchanged_nodes(nodes, args.parallel)
+      if unchanged:
+        logging.info(f'Skipped {len(unchanged)} unchanged node(s).')
+
+      changed = [name for name in nodes if name not in unchanged]
+      if not changed:
+        return
+
+      on = ','.join(changed) if args.on or unchanged else None
+    else:
+      on = self.colmena_on(args.on)
+
     cmd = ['colmena', '--config', self.generate_hive_nix(full_eval=True), 'apply']
     if args.show_trace:
       cmd += ['--show-trace']
     if args.verbose:
       cmd += ['--verbose']
-    if args.on:
-      cmd += ['--on', args.on]
+    if on:
+      cmd += ['--on', on]
     cmd += ['--evaluator', 'streaming']
     if not (args.eval_node_limit is None):
       cmd += ['--eval-node-limit', str(args.eval_node_limit)]
@@ -490,7 +1854,7 @@ class App:
       cmd += ['boot', '--reboot']
     else:
       cmd += ['switch']
-    subprocess.run(cmd, check=True)
+    tracer.run(cmd, check=True)
 
   def destroy(self, args):
     self.generate_main_tf_json(refresh=True)
@@ -499,11 +1863,13 @@ class App:
     if args.confirm:
       cmd += ['-auto-approve']
 
-    subprocess.run(cmd, check=True)
+    tracer.run(cmd, check=True)
+    self.state.invalidate()
+
+    self.save_inventory(None)
 
   def info(self, args):
-    with open(self.generate_terraform_json(), 'r') as fp:
-      data = json.load(fp)
+    data = self.terraform_data()
 
     # filter out internal state
 
@@ -521,15 +1887,24 @@ class App:
     except KeyError:
       pass
 
-    print(json.dumps(data['resources'], indent=2))
+    if args.facts_ttl is not None:
+      print(json.dumps(dict(resources=data['resources'], facts=self.load_facts(args.facts_ttl)), indent=2))
+    else:
+      print(json.dumps(data['resources'], indent=2))
 
   def check(self, args):
     nodes = self.query_deployment()
+    facts = self.load_facts(args.facts_ttl) if args.facts_ttl is not None else dict()
 
     length = len(max(nodes.keys(), key = len)) if nodes else len('ERROR')
 
     async def uptime(name, node):
-      process = await asyncio.create_subprocess_exec(*ssh(node, ['uptime']), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+      if name in facts:
+        age = time.time() - facts[name]['collected']
+        print(colored(name.ljust(length), color='green', attrs=['bold']), '|', colored(f'{facts_summary(facts[name])} ({age:.0f}s ago)', color='green'))
+        return True
+
+      process = await tracer.create_subprocess_exec(*ssh(node, ['uptime']), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
       stdout, _ = await process.communicate()
 
       if process.returncode != 0:
@@ -537,32 +1912,50 @@ class App:
       else:
         print(colored(name.ljust(length), color='green', attrs=['bold']), '|', colored(stdout.decode().rstrip(), color='green'))
 
-    async def run():
-      tasks = [uptime(name, node) for name, node in nodes.items()]
-      return await asyncio.gather(*tasks)
+      return process.returncode == 0
 
-    asyncio.run(run())
+    scheduler = self.scheduler(args)
+    asyncio.run(scheduler.run(nodes, uptime))
+
+    if scheduler.failed or scheduler.skipped:
+      sys.exit(1)
 
   def set_args(self, args):
+    arguments = dict(self.teraflops_arguments)
+
+    if args.file:
+      with open(args.file, 'rb') as fp:
+        arguments.update(tomllib.load(fp) if args.file.endswith('.toml') else json.load(fp))
+
     if args.arg:
-      for (name, value) in args.arg:
-        new_value = json.loads(subprocess.check_output(['nix', '--extra-experimental-features', 'nix-command', 'eval', '--json', '--expr', '%s' % value]))
-        self.teraflops_arguments[name] = new_value
+      # a single nix process for every value, each on lines of its own so a trailing comment can't swallow the rest
+      expr = '[\n%s\n]' % '\n'.join('(\n%s\n)' % value for (_, value) in args.arg)
+      values = json.loads(tracer.run(['nix', '--extra-experimental-features', 'nix-command', 'eval', '--json', '--expr', expr], stdout=subprocess.PIPE, check=True).stdout)
+
+      for (name, _), value in zip(args.arg, values):
+        arguments[name] = value
 
     if args.argstr:
       for (name, value) in args.argstr:
-        self.teraflops_arguments[name] = value
+        arguments[name] = value
 
     if args.unset:
       for name in args.unset:
-        if name in self.teraflops_arguments: del self.teraflops_arguments[name]
+        if name in arguments: del arguments[name]
+
+    if arguments == self.teraflops_arguments:
+      logging.info('Arguments are unchanged, nothing to do.')
+      return
+
+    self.teraflops_arguments = arguments
 
     with open(os.path.join(self.tempdir, 'arguments.json'), 'w') as fp:
-      fp.write(json.dumps(self.teraflops_arguments, indent=2, sort_keys=True))
+      fp.write(json.dumps(self.teraflops_arguments, separators=(',', ':'), sort_keys=True))
 
     self.generate_main_tf_json(refresh=False, rewrite_args=True)
 
-    subprocess.run([self.terraform, 'apply', '-target=terraform_data.teraflops-arguments', '-auto-approve'], stdout=subprocess.DEVNULL, check=True)
+    tracer.run([self.terraform, 'apply', '-target=terraform_data.teraflops-arguments', '-auto-approve'], stdout=subprocess.DEVNULL, check=True)
+    self.state.invalidate()
 
   def show_args(self, args):
     if args.json:
@@ -585,18 +1978,20 @@ class App:
       'BatchMode=yes',
     ]
 
+    cmd += ssh_control_args()
+
     if os.environ.get('SSH_CONFIG_FILE'):
       cmd += ['-F', os.environ['SSH_CONFIG_FILE']]
 
     if node.get('targetPort'):
-      cmd += ['-p', node['targetPort']]
+      cmd += ['-p', str(node['targetPort'])]
 
     if node.get('targetUser'):
       cmd += ['-l', node.get('targetUser')]
 
     cmd += [node['targetHost']]
 
-    subprocess.run(cmd, check=True)
+    tracer.run(cmd, check=True)
 
   def ssh_for_each(self, args):
     nodes = self.query_deployment()
@@ -613,38 +2008,47 @@ class App:
     else:
       logging.warning('No hosts selected (0 skipped).')
 
-    length = len(max(nodes.keys(), key = len)) if nodes else len('ERROR')
+    output = NodeOutput(nodes.keys(), args.log_dir)
 
     async def execute(name, node):
-      process = await asyncio.create_subprocess_exec(*ssh(node, args.command), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-      stdout, stderr = await process.communicate()
+      process = await tracer.create_subprocess_exec(*ssh(node, args.command), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
 
-      for line in stdout.decode().splitlines():
-        print(colored(name.ljust(length), attrs=['bold']), '|', line.rstrip())
+      async def forward(stream):
+        async for line in read_lines(stream):
+          output.print(name, line)
 
-      if process.returncode == 0:
-        return stdout.decode()
+      await asyncio.gather(forward(process.stdout), forward(process.stderr))
 
-      if process.returncode != 0:
-        print(colored(name.ljust(length), color='red', attrs=['bold']), '|', colored('Failed: %s' % stderr.decode().rstrip(), color='red'))
-      else:
-        print(colored(name.ljust(length), color='green', attrs=['bold']), '|', colored('Succeeded', color='green'))
+      if await process.wait() == 0:
+        return True
 
-    async def run():
-      tasks = [execute(name, node) for name, node in nodes.items()]
-      return await asyncio.gather(*tasks)
+      output.print(name, 'Failed: exit code %d' % process.returncode, color='red')
+      return False
 
-    asyncio.run(run())
-    print(''.ljust(length), '|', colored('All done!', color='green'))
+    scheduler = self.scheduler(args)
+    try:
+      asyncio.run(scheduler.run(nodes, execute))
+    finally:
+      output.close()
+
+    if scheduler.failed or scheduler.skipped:
+      sys.exit(1)
+
+    print(''.ljust(output.length), '|', colored('All done!', color='green'))
 
   def scp(self, args):
     nodes = self.query_deployment()
 
+    if not (args.on is None):
+      return self.scp_for_each(args, nodes)
+
     cmd = ['scp']
 
     if args.r:
       cmd += ['-r']
 
+    cmd += ssh_control_args()
+
     if os.environ.get('SSH_CONFIG_FILE'):
       cmd += ['-F', os.environ['SSH_CONFIG_FILE']]
 
@@ -657,20 +2061,9 @@ class App:
       node = nodes[source_machine]
 
       if node.get('targetPort'):
-        cmd += ['-P', node['targetPort']]
-
-      source = ''
-      if node.get('targetUser'):
-        source += node.get('targetUser')
-        source += '@'
-      if ':' in node['targetHost']:
-        source += '['
-        source += node['targetHost']
-        source += ']'
-      else:
-        source += node['targetHost']
-      source += ':'
-      source += source_path
+        cmd += ['-P', str(node['targetPort'])]
+
+      source = scp_remote(node, source_path)
 
     if ':' in args.target:
       target_machine, _, target_path = args.target.partition(':')
@@ -678,24 +2071,110 @@ class App:
       node = nodes[target_machine]
 
       if node.get('targetPort'):
-        cmd += ['-P', node['targetPort']]
-
-      target = ''
-      if node.get('targetUser'):
-        target += node.get('targetUser')
-        target += '@'
-      if ':' in node['targetHost']:
-        target += '['
-        target += node['targetHost']
-        target += ']'
-      else:
-        target += node['targetHost']
-      target += ':'
-      target += target_path
+        cmd += ['-P', str(node['targetPort'])]
+
+      target = scp_remote(node, target_path)
 
     cmd += [source, target]
 
-    subprocess.run(cmd, check=True)
+    tracer.run(cmd, check=True)
+
+  # copy to (`scp --on @web file :/path`) or from (`scp --on @web :/path dir`) many nodes at once
+  def scp_for_each(self, args, nodes):
+    count = len(nodes)
+    nodes = NodeFilter(args.on).filter(nodes)
+
+    logging.info('Enumerating nodes..')
+
+    if nodes:
+      logging.info(f'Selected {len(nodes)} out of {count} hosts.')
+    else:
+      logging.warning('No hosts selected (0 skipped).')
+
+    if args.source.startswith(':') == args.target.startswith(':'):
+      logging.error('with --on exactly one of source or target must be a remote path of the form :<PATH>')
+      sys.exit(1)
+
+    fan_in = args.source.startswith(':')
+    remote_path = (args.source if fan_in else args.target)[1:]
+
+    if args.checksum and args.r:
+      logging.warning('--checksum is ignored for recursive copies')
+
+    # the file on each node which the checksum is compared against
+    if not fan_in and (remote_path.endswith('/') or not remote_path):
+      checksum_path = remote_path + os.path.basename(args.source.rstrip('/'))
+    else:
+      checksum_path = remote_path
+
+    output = NodeOutput(nodes.keys())
+    done = 0
+
+    async def checksum(node):
+      proc = await tracer.create_subprocess_exec(*ssh(node, ['sha256sum', checksum_path]), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+      stdout, _ = await proc.communicate()
+
+      return stdout.decode().split(' ')[0] if proc.returncode == 0 else None
+
+    async def copy(name, node):
+      nonlocal done
+
+      local = os.path.join(args.target, name) if fan_in else args.source
+      local_file = os.path.join(local, os.path.basename(remote_path)) if fan_in else local
+
+      if args.checksum and not args.r and os.path.isfile(local_file):
+        with open(local_file, 'rb') as fp:
+          digest = hashlib.file_digest(fp, 'sha256').hexdigest()
+
+        if await checksum(node) == digest:
+          done += 1
+          output.print(name, f'[{done}/{len(nodes)}] Unchanged', color='green')
+          return True
+
+      cmd = ['scp']
+      if args.r:
+        cmd += ['-r']
+      cmd += ssh_control_args()
+      if os.environ.get('SSH_CONFIG_FILE'):
+        cmd += ['-F', os.environ['SSH_CONFIG_FILE']]
+      if node.get('targetPort'):
+        cmd += ['-P', str(node['targetPort'])]
+
+      if fan_in:
+        os.makedirs(local, exist_ok=True)
+        cmd += [scp_remote(node, remote_path), local + os.sep]
+      else:
+        cmd += [local, scp_remote(node, remote_path)]
+
+      # whole seconds as not every filesystem keeps finer timestamps
+      written_since = int(time.time())
+
+      started = time.monotonic()
+      proc = await tracer.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+      _, stderr = await proc.communicate()
+      elapsed = time.monotonic() - started
+
+      done += 1
+
+      if proc.returncode != 0:
+        output.print(name, f'[{done}/{len(nodes)}] Failed: %s' % stderr.decode().rstrip(), color='red')
+        return False
+
+      # on fan in <TARGET>/<NODE> may still hold files of earlier copies, only count what this one wrote
+      size = disk_usage(local, written_since if fan_in else None) / 1024 / 1024
+      output.print(name, f'[{done}/{len(nodes)}] Copied {size:.1f} MiB in {elapsed:.1f}s ({size / max(elapsed, 0.001):.1f} MiB/s)', color='green')
+      return True
+
+    scheduler = self.scheduler(args)
+
+    started = time.monotonic()
+    asyncio.run(scheduler.run(nodes, copy))
+    elapsed = time.monotonic() - started
+
+    if scheduler.failed or scheduler.skipped:
+      sys.exit(1)
+
+    print(''.ljust(output.length), '|', colored(f'All done in {elapsed:.1f}s!', color='green'))
 
   # adapted from https://github.com/zhaofengli/colmena/blob/main/src/nix/host/ssh.rs
   # TODO: it would be nice to get a 'reboot' command right into colmena
@@ -718,54 +2197,108 @@ class App:
 
     length = len(max(nodes.keys(), key = len)) if nodes else len('ERROR')
 
-    async def get_boot_id(node):
-      ssh_args = ['-o', 'ConnectTimeout=10'] # see https://github.com/zhaofengli/colmena/issues/166#issuecomment-1892325999
-      proc = await asyncio.create_subprocess_exec(*ssh(node, ['cat', '/proc/sys/kernel/random/boot_id'], ssh_args), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
-      stdout, _ = await proc.communicate()
-
-      return None if proc.returncode != 0 else stdout.decode()
+    # only ssh counts against --parallel, a node which is waited on to come back holds no slot or large deployments
+    # would reboot in waves, --tag-limit does span the whole reboot though (ie. one database server at a time)
+    parallel = Scheduler.default_parallel if args.parallel is None else args.parallel
+    ssh_limit = asyncio.Semaphore(parallel) if parallel > 0 else contextlib.nullcontext()
 
     async def initiate_reboot(node):
-      proc = await asyncio.create_subprocess_exec(*ssh(node, ['reboot']), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
-      stdout, _ = await proc.communicate()
+      async with ssh_limit:
+        proc = await tracer.create_subprocess_exec(*ssh(node, ['reboot']), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        stdout, _ = await proc.communicate()
 
       if proc.returncode == 0 or proc.returncode == 255:
         return stdout.decode()
 
+    async def current_boot_id(node):
+      async with ssh_limit:
+        return await boot_id(node)
+
+    waiter = NodeWaiter(args.wait_timeout)
+
     async def reboot(name, node):
-      print(colored(name.ljust(length), attrs=['bold']), '| Rebooting')
+      waiter.print(colored(name.ljust(length), attrs=['bold']), '| Rebooting')
 
       if args.no_wait:
-        return await initiate_reboot(node)
+        await initiate_reboot(node)
+        return True
 
-      old_id = await get_boot_id(node)
+      # never a cached one, the node may have booted again since it was collected
+      old_id = await current_boot_id(node)
 
       await initiate_reboot(node)
 
-      print(colored(name.ljust(length), attrs=['bold']), '| Waiting for reboot')
+      # the master connection went down with the node, don't wait for ssh to notice
+      async with ssh_limit:
+        proc = await tracer.create_subprocess_exec(*ssh(node, [], ['-O', 'exit']), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        await proc.wait()
 
-      while True:
-        new_id = await get_boot_id(node)
-        if new_id and new_id != old_id:
-          break
+      waiter.print(colored(name.ljust(length), attrs=['bold']), '| Waiting for reboot')
 
-        await asyncio.sleep(2)
+      async def rebooted(node):
+        new_id = await current_boot_id(node)
+        return new_id is not None and new_id != old_id
 
-      print(colored(name.ljust(length), color='green', attrs=['bold']), '|', colored('Rebooted', color='green'))
+      if not await waiter.wait(name, node, rebooted):
+        waiter.print(colored(name.ljust(length), color='red', attrs=['bold']), '|', colored('Timed out', color='red'))
+        return False
 
-    async def run():
-      tasks = [reboot(name, node) for name, node in nodes.items()]
-      return await asyncio.gather(*tasks)
+      waiter.print(colored(name.ljust(length), color='green', attrs=['bold']), '|', colored('Rebooted', color='green'))
+
+      return True
+
+    scheduler = Scheduler(0, args.tag_limit, args.fail_fast)
+    asyncio.run(scheduler.run(nodes, reboot))
+
+    self.save_facts(forget=nodes)
+
+    if scheduler.failed or scheduler.skipped:
+      sys.exit(1)
 
-    asyncio.run(run())
     print(''.ljust(length), '|', colored('All done!', color='green'))
 
+  def facts(self, args):
+    nodes = self.query_deployment()
+
+    if not (args.on is None):
+      node_filter = NodeFilter(args.on)
+      nodes = node_filter.filter(nodes)
+
+    output = NodeOutput(list(nodes))
+    collected = dict()
+
+    async def collect(name, node):
+      facts = await collect_facts(node)
+      if facts is None:
+        output.print(name, 'unavailable', color='red')
+        return False
+
+      collected[name] = facts
+      if not args.json:
+        output.print(name, facts_summary(facts), color='red' if facts['failed_units'] else 'green')
+
+      return True
+
+    scheduler = self.scheduler(args)
+    asyncio.run(scheduler.run(nodes, collect))
+
+    self.save_facts(collected)
+
+    if args.json:
+      print(json.dumps(collected, indent=2, sort_keys=True))
+
+    if scheduler.failed or scheduler.skipped:
+      sys.exit(1)
+
   def run(self):
     parser = argparse.ArgumentParser(description='a terraform ops tool which is sure to be a flop')
     parser.add_argument('-f', '--config', default='.', help='...')
     parser.add_argument('--show-trace', action='store_true', help='passes --show-trace to nix commands')
     parser.add_argument('-q', '--quiet', action='store_true')
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--no-daemon', action='store_true', help='do not use a running `teraflops serve` daemon')
+    parser.add_argument('--trace-file', metavar='<FILE>', help='write a trace of every external command and node task to <FILE> in the chrome trace event format')
+    parser.add_argument('--ssh-persist', metavar='<DURATION>', help='keep SSH master connections open for <DURATION> (ie. 10m) after exiting so later invocations can reuse them')
 
     confirm_parser = argparse.ArgumentParser(add_help=False)
     confirm_parser.add_argument('--confirm', action='store_true', help='confirm dangerous operations; do not ask')
@@ -779,6 +2312,13 @@ class App:
     parallel_parser = argparse.ArgumentParser(add_help=False)
     parallel_parser.add_argument('--parallel', metavar='<LIMIT>', type=int, help='limits the maximum number of hosts to be deployed in parallel')
 
+    scheduler_parser = argparse.ArgumentParser(add_help=False, parents=[parallel_parser])
+    scheduler_parser.add_argument('--tag-limit', metavar='<TAG>=<LIMIT>', type=tag_limit, action='append', help='limits the maximum number of hosts with the given tag to be processed in parallel')
+    scheduler_parser.add_argument('--fail-fast', action='store_true', help='stop starting new hosts after the first failure')
+
+    facts_ttl_parser = argparse.ArgumentParser(add_help=False)
+    facts_ttl_parser.add_argument('--facts-ttl', metavar='<SECONDS>', type=int, help='trust facts collected by `teraflops facts` at most <SECONDS> ago instead of probing nodes')
+
     subparsers = parser.add_subparsers(title='subcommands') #, dest='subcommand')
 
     # subparser for the 'init' command
@@ -793,22 +2333,30 @@ class App:
     repl_parser.set_defaults(func=self.repl)
 
     # subparser for the 'eval' command
-    eval_parser = subparsers.add_parser('eval', help='evaluate an expression using the complete configuration')
+    eval_parser = subparsers.add_parser('eval', parents=[parallel_parser], help='evaluate an expression using the complete configuration')
     eval_parser.set_defaults(func=self.eval)
+    eval_parser.add_argument('--batch-size', metavar='<SIZE>', type=int, help='evaluate at most <SIZE> expressions per evaluation of the configuration, by default all expressions share a single evaluation')
     eval_parser.add_argument('expr', nargs='+', type=str, help='the nix expression(s) to evaluate')
 
     # subparser for the 'deploy' command
-    deploy_parser = subparsers.add_parser('deploy', parents=[confirm_parser, on_parser, eval_node_limit_parser, parallel_parser], help='deploy the configuration')
+    deploy_parser = subparsers.add_parser('deploy', parents=[confirm_parser, on_parser, eval_node_limit_parser, parallel_parser, facts_ttl_parser], help='deploy the configuration')
     deploy_parser.set_defaults(func=self.deploy)
     deploy_parser.add_argument('--reboot', action='store_true', help='reboots nodes after activation and waits for them to come back up')
+    deploy_parser.add_argument('--pipeline', action='store_true', help='activate nodes in batches as soon as they are reachable instead of waiting for all of them')
+    deploy_parser.add_argument('--plan', metavar='<FILE>', help='apply a plan saved by `plan --out` instead of planning again')
+    deploy_parser.add_argument('--no-target', action='store_true', help='with --on, apply every terraform resource instead of only those belonging to the selected nodes')
+    deploy_parser.add_argument('--skip-unchanged', action='store_true', help='do not activate nodes which already run the evaluated system, at the cost of an additional evaluation')
+    deploy_parser.add_argument('--wait-timeout', metavar='<SECONDS>', type=int, help='give up on nodes which are not reachable after <SECONDS>')
 
     # subparser for the 'plan' command
     plan_parser = subparsers.add_parser('plan', help='show changes required by the current configuration')
     plan_parser.set_defaults(func=self.plan)
+    plan_parser.add_argument('--out', metavar='<FILE>', help='save the plan to <FILE> so `apply --plan` and `deploy --plan` can apply it without planning again')
 
     # subparser for the 'apply' command
     apply_parser = subparsers.add_parser('apply', parents=[confirm_parser], help='create or update all resources in the deployment')
     apply_parser.set_defaults(func=self.apply)
+    apply_parser.add_argument('--plan', metavar='<FILE>', help='apply a plan saved by `plan --out` instead of planning again')
 
     # subparser for the 'build' command
     build_parser = subparsers.add_parser('build', parents=[on_parser, eval_node_limit_parser], help='build the system profiles')
@@ -822,17 +2370,18 @@ class App:
     activate_parser = subparsers.add_parser('activate', parents=[on_parser, eval_node_limit_parser, parallel_parser], help='apply configurations on remote nodes')
     activate_parser.set_defaults(func=self.activate)
     activate_parser.add_argument('--reboot', action='store_true', help='reboots nodes after activation and waits for them to come back up')
+    activate_parser.add_argument('--skip-unchanged', action='store_true', help='do not activate nodes which already run the evaluated system, at the cost of an additional evaluation')
 
     # subparser for the 'destroy' command
     destroy_parser = subparsers.add_parser('destroy', parents=[confirm_parser], help='destroy all resources in the deployment')
     destroy_parser.set_defaults(func=self.destroy)
 
     # subparser for the 'info' command
-    info_parser = subparsers.add_parser('info', help='show the state of the deployment')
+    info_parser = subparsers.add_parser('info', parents=[facts_ttl_parser], help='show the state of the deployment')
     info_parser.set_defaults(func=self.info)
 
     # subparser for the 'check' command
-    check_parser = subparsers.add_parser('check', help='attempt to connect to each node via SSH and print the results of the uptime command.')
+    check_parser = subparsers.add_parser('check', parents=[scheduler_parser, facts_ttl_parser], help='attempt to connect to each node via SSH and print the results of the uptime command.')
     check_parser.set_defaults(func=self.check)
 
     # subparser for the 'set-args' command
@@ -840,6 +2389,7 @@ class App:
     set_args_parser.set_defaults(func=self.set_args)
     set_args_parser.add_argument('--arg', nargs=2, action='append', metavar=('name', 'value'), help='set the function argument name to value, where the latter is an arbitrary nix expression')
     set_args_parser.add_argument('--argstr', nargs=2, action='append', metavar=('name', 'value'), help='like --arg, but the value is a literal string rather than a nix expression')
+    set_args_parser.add_argument('--file', metavar='<FILE>', help='set every function argument in <FILE>, a JSON or (with a .toml extension) TOML document, applied before any other option')
     set_args_parser.add_argument('--unset', action='append', metavar='name', help='remove a previously set function argument')
 
     # subparser for the 'show-args' command
@@ -853,21 +2403,34 @@ class App:
     ssh_parser.add_argument('node', type=str, help='identifier of the node')
 
     # subparser for the 'ssh_for_each' command
-    ssh_for_each_parser = subparsers.add_parser('ssh-for-each', parents=[on_parser], help='execute a command on each machine via SSH')
+    ssh_for_each_parser = subparsers.add_parser('ssh-for-each', parents=[on_parser, scheduler_parser], help='execute a command on each machine via SSH')
     ssh_for_each_parser.set_defaults(func=self.ssh_for_each)
+    ssh_for_each_parser.add_argument('--log-dir', metavar='<DIR>', help='additionally write the output of each node to <DIR>/<NODE>.log')
     ssh_for_each_parser.add_argument('command', nargs=argparse.REMAINDER, help='command to run')
 
     # subparser for the 'scp' command
-    scp_parser = subparsers.add_parser('scp', help='copy files to or from the specified machine via scp')
+    scp_parser = subparsers.add_parser('scp', parents=[on_parser, scheduler_parser], help='copy files to or from the specified machine via scp, or with --on to or from many machines at once')
     scp_parser.set_defaults(func=self.scp)
     scp_parser.add_argument('-r', action='store_true', help='recursively copy entire directories')
-    scp_parser.add_argument('source', type=str, help='source file location')
-    scp_parser.add_argument('target', type=str, help='destination file location')
+    scp_parser.add_argument('--checksum', action='store_true', help='with --on, skip nodes where the file is already identical')
+    scp_parser.add_argument('source', type=str, help='source file location, with --on a remote source is given as :<PATH> and copied into <TARGET>/<NODE>')
+    scp_parser.add_argument('target', type=str, help='destination file location, with --on a remote destination is given as :<PATH>')
 
-    reboot_parser = subparsers.add_parser('reboot', parents=[on_parser], help='reboot all nodes in the deployment')
+    reboot_parser = subparsers.add_parser('reboot', parents=[on_parser, scheduler_parser], help='reboot all nodes in the deployment')
     reboot_parser.set_defaults(func=self.reboot)
     reboot_parser.add_argument('--no-wait', action='store_true', help='do not wait until the nodes are up again')
+    reboot_parser.add_argument('--wait-timeout', metavar='<SECONDS>', type=int, help='give up on nodes which are not back up after <SECONDS>')
+
 
+    # subparser for the 'facts' command
+    facts_parser = subparsers.add_parser('facts', parents=[on_parser, scheduler_parser], help='collect facts (boot id, system, kernel, load, memory, disk and failed units) from each node and cache them')
+    facts_parser.set_defaults(func=self.facts)
+    facts_parser.add_argument('--json', action='store_true', help='print the collected facts as JSON')
+
+    # subparser for the 'serve' command
+    serve_parser = subparsers.add_parser('serve', help='keep the deployment loaded and answer eval, info, check and ssh-for-each from memory')
+    serve_parser.set_defaults(func=self.serve)
+    serve_parser.add_argument('--state-ttl', metavar='<SECONDS>', type=int, default=60, help='reload the terraform state at least every <SECONDS>, changes to local files are picked up immediately')
 
     # TODO: different subparser
 
@@ -890,19 +2453,54 @@ class App:
       try:
         self.config = args.config
         self.show_trace = args.show_trace
+        self.state = TerraformState(self.terraform)
+        self.flake = FlakeResolver(self.config)
+
+        ssh_control(self.tempdir, args.ssh_persist)
+
+        if args.verbose:
+          logging.getLogger().setLevel(logging.DEBUG)
+          logging.getLogger('asyncio').setLevel(logging.INFO)
+
+        # a daemon would accumulate spans forever
+        tracer.enabled = (args.verbose or bool(args.trace_file)) and args.func != self.serve
+
+        # these commands can be answered by a running `teraflops serve` which has everything loaded already
+        if args.func in [self.eval, self.info, self.check, self.ssh_for_each] and not args.no_daemon:
+          self.daemon = DaemonClient.connect(daemon_socket(), self.config)
 
-        # 'init' is the only function which doesn't require arguments... all it does is prep the directory
-        if args.func != self.init:
-          self.generate_arguments_json()
+        # these commands only need to know about the nodes, which may have been cached by an earlier invocation
+        if args.func in [self.ssh, self.scp, self.check, self.reboot, self.ssh_for_each, self.facts] and not self.daemon:
+          self.inventory = self.load_inventory()
 
-        self.generate_eval_nix()
+        # 'serve' loads the deployment on demand and a daemon has everything loaded already
+        if not self.daemon and self.inventory is None and args.func != self.serve:
+          # 'init' is the only function which doesn't require arguments... all it does is prep the directory
+          arguments = args.func != self.init
+
+          # these regenerate main.tf.json, unless a saved plan is applied
+          metadata = args.func in [self.tf, self.deploy, self.plan, self.apply, self.destroy] and not getattr(args, 'plan', None)
+
+          self.prepare(arguments, metadata)
 
         args.func(args)
       except subprocess.CalledProcessError as e:
         sys.exit(e.returncode)
+      except DaemonError as e:
+        logging.error(str(e))
+        sys.exit(1)
       finally:
-        with contextlib.suppress(FileNotFoundError):
-          os.remove('main.tf.json')
+        ssh_control_exit(self.tempdir)
+
+        # see `private_workdir`
+        if args.func != self.serve:
+          with contextlib.suppress(FileNotFoundError):
+            os.remove('main.tf.json')
+
+        if args.verbose:
+          tracer.summary()
+        if args.trace_file:
+          tracer.export(args.trace_file)
     else:
       # if no subcommand is provided, print help
       parser.print_help()
@@ -21,8 +21,8 @@ let
 
   terraform =
     let
-      # `terraform.json` is a slightly processed version of `terraform show -json` produced by `teraflops` for consumption here
-      value = with builtins; lib.optionalAttrs (pathExists ./terraform.json) (fromJSON (readFile ./terraform.json));
+      # a slightly processed version of `terraform show -json` produced by `teraflops` for consumption here, see `state.nix`
+      value = with builtins; lib.optionalAttrs (pathExists ./terraform.json) (import ./state.nix);
     in
     {
       outputs = value.outputs or null;
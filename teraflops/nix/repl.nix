@@ -9,7 +9,7 @@ in
   colmena.introspect ({ nodes, pkgs, lib, ... }:
   let
     arguments = with builtins; fromJSON (readFile ./arguments.json);
-    terraform = with builtins; fromJSON (readFile ./terraform.json);
+    terraform = import ./state.nix;
   in
   {
     inherit nodes pkgs lib;
@@ -0,0 +1,11 @@
+# this file reads the terraform state `teraflops` writes for nix, `terraform.json` only holds the outputs and an index of
+# resource types while the resources of each type are in a file of their own which is only parsed once something
+# actually refers to them
+with builtins;
+let
+  index = fromJSON (readFile ./terraform.json);
+in
+{
+  inherit (index) outputs;
+  resources = listToAttrs (map (type: { name = type; value = fromJSON (readFile (./terraform + "/${type}.json")); }) index.types);
+}
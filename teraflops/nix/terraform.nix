@@ -1,5 +1,8 @@
 # this file takes a teraflops deploy and turns it into something terraform expects
-{ path ? "%s" }:
+#
+# with `lightweight` nodes are not evaluated as full NixOS systems, only `deployment.*` is, which is what terraform
+# code is generally interested in - anything else is accepted as is and never looked at
+{ path ? "%s", lightweight ? false }:
 let
   colmena = import "${path}/eval.nix" {
     colmenaModules = import "${path}/modules.nix";
@@ -7,8 +10,35 @@ let
     rawHive = import ./hive.nix;
   };
   pkgs = colmena.introspect({ pkgs, ... }: pkgs);
-in
-  (pkgs.formats.json {}).generate "main.tf.json" (colmena.introspect (
+
+  lightweightNodes = with pkgs.lib;
+    let
+      hive = import ./hive.nix;
+      colmenaOptions = import "${path}/options.nix";
+    in
+    genAttrs (filter (name: !elem name [ "defaults" "network" "meta" ]) (attrNames hive)) (name: evalModules {
+      modules = [
+        {
+          _module.check = false;
+          _module.freeformType = with types; lazyAttrsOf anything;
+          _module.args.pkgs = pkgs;
+        }
+        colmenaOptions.deploymentOptions
+        (hive.defaults or { })
+      ] ++ (if builtins.isList hive.${name} then hive.${name} else [ hive.${name} ]);
+      specialArgs = {
+        inherit name;
+        nodes = lightweightNodes;
+        modulesPath = "${pkgs.path}/nixos/modules";
+      } // (hive.meta.specialArgs or { }) // (hive.meta.nodeSpecialArgs.${name} or { });
+    });
+
+  introspect = if lightweight
+    then f: f { inherit pkgs; inherit (pkgs) lib; nodes = lightweightNodes; }
+    else colmena.introspect;
+
+  # NOTE: top level objects which don't refer to `nodes` (ie. `provider`, `terraform`) never cause any node to be evaluated
+  tf = introspect (
     { nodes, pkgs, lib, ... }: with lib;
     let
       eval = import ./eval.nix { };
@@ -36,4 +66,6 @@ in
         # hack to account for provider aliases: https://developer.hashicorp.com/terraform/language/providers/configuration#alias-multiple-provider-configurations
         provider = flatten (mapAttrsToList (name: attrs: [ { "${name}" = builtins.removeAttrs attrs ["__aliases"]; } ] ++ (mapAttrsToList (k: v: { "${k}" = v; }) (attrs.__aliases or { }))) value.provider);
       }
-  ))
+  );
+in
+  pkgs.writeText "main.tf.json" (builtins.toJSON tf)